@@ -0,0 +1,178 @@
+""" Solve every level of one or more level-set files, in parallel.
+Results are printed as JSON lines as soon as each level is done.
+The --timeout and --max-memory limits are checked by the solver as it
+searches, see solver.Search.check_limits, not enforced on the worker
+processes: a level may run a little over its time, and a worker uses more
+memory than its search nodes.
+Run from the src folder, eg:
+    python batch_solve.py ../assets/maps_after_all.txt --timeout 10 \
+        --output results.jsonl --resume
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import logging
+import os
+import sys
+from level import load_level_set
+from solution_db import SolutionStore, record_from_result
+from solver import solve, ANY, MEMORY_LIMIT, MOVES, PUSHES, SOLVED
+
+
+def solve_one(path, level, method, max_seconds, max_memory, max_nodes,
+              objective=PUSHES):
+    """ worker: solve level, return its result as a dict.
+    Solved levels return a full solution record (see solution_db).
+    """
+    try:
+        res = solve(level, method, max_nodes, max_seconds, max_memory,
+                    objective=objective)
+    except MemoryError:
+        res = None
+    if res is not None and res.solved:
+        out = record_from_result(level, res, method, objective)
+    else:
+        out = {
+            'digest': level.digest(),
+            'level_num': level.level_num,
+            'nodes': res.nodes if res else None,
+            'seconds': round(res.seconds, 3) if res else None,
+        }
+    out['file'] = path
+    out['status'] = res.status if res else MEMORY_LIMIT
+    return out
+
+
+def read_checkpoint(filename):
+    """ return the set of (file, level_num) already in the results file """
+    done = set()
+    if not os.path.isfile(filename):
+        return done
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+                done.add((r['file'], r['level_num']))
+            except (ValueError, KeyError):
+                pass  # line cut short when the previous run was killed
+    return done
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('files', nargs='+', help='level-set files')
+    p.add_argument('--workers', type=int, default=os.cpu_count(),
+                   help='number of solver processes')
+    p.add_argument('--timeout', type=float, default=60,
+                   help='seconds allowed per level (best-effort)')
+    p.add_argument('--max-memory', type=float, default=None,
+                   help='megabytes of search nodes allowed per level'
+                   ' (best-effort: other memory is not counted)')
+    p.add_argument('--max-nodes', type=int, default=None,
+                   help='expanded nodes allowed per level')
+    p.add_argument('--method', choices=['astar', 'idastar'], default='astar')
+    p.add_argument('--objective', choices=[PUSHES, MOVES, ANY],
+                   default=PUSHES,
+                   help='fewest pushes, fewest moves, or any solution')
+    p.add_argument('--maxsize', type=int, default=None,
+                   help='maximum width and height of a level (default: any)')
+    p.add_argument('--output', default=None,
+                   help='append results to this file instead of stdout')
+    p.add_argument('--resume', action='store_true',
+                   help='skip levels already in the --output file')
+    p.add_argument('--store', action='store_true',
+                   help='save solutions next to each level-set file')
+    args = p.parse_args(argv)
+    if args.method == 'idastar' and args.objective == ANY:
+        p.error('idastar only searches optimal solutions')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    log = logging.getLogger('game')
+    done = set()
+    if args.resume:
+        if not args.output:
+            log.error('--resume needs an --output file')
+            return 2
+        done = read_checkpoint(args.output)
+        log.info('resuming: %d levels already done' % len(done))
+
+    level_sets = []
+    for path in args.files:
+        # in this process, before the solver processes start: a parallel
+        # loader would compete with them for the cpus
+        levels = load_level_set(path, args.maxsize)
+        if levels is not None:
+            level_sets.append((path, levels))
+    out = open(args.output, 'a') if args.output else sys.stdout
+    stores = {}
+    n_solved = n_total = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = []
+            for path, levels in level_sets:
+                if args.store:
+                    stores[path] = SolutionStore(path)
+                for level in levels:
+                    if (path, level.level_num) in done:
+                        continue
+                    futures.append(pool.submit(
+                        solve_one, path, level, args.method, args.timeout,
+                        args.max_memory, args.max_nodes, args.objective))
+            for fut in as_completed(futures):
+                r = fut.result()
+                n_total += 1
+                if r['status'] == SOLVED:
+                    n_solved += 1
+                    if args.store:
+                        stores[r['file']].put(r)
+                out.write(json.dumps(r, separators=(',', ':')) + '\n')
+                out.flush()
+    finally:
+        for store in stores.values():
+            store.flush()
+        if out is not sys.stdout:
+            out.close()
+    log.info('solved %d of %d levels' % (n_solved, n_total))
+    return 0
+
+
+################# TESTS ##################
+
+
+def test_batch_solve():
+    filename = 'levelset.txt.test'
+    output = 'results.jsonl.test'
+    with open(filename, 'w') as f:
+        f.write('\n'.join(['#####', '#@$.#', '#####']) + '\n\n')
+        f.write('\n'.join(['######', '#@$ .#', '######']) + '\n')
+    args = [filename, '--workers', '2', '--output', output, '--store']
+    assert main(args) == 0
+    with open(output) as f:
+        results = [json.loads(line) for line in f]
+    assert sorted(r['n_pushes'] for r in results) == [1, 2]
+    assert len(SolutionStore(filename)) == 2
+    # resume: everything is done already, nothing is appended
+    assert main(args + ['--resume']) == 0
+    with open(output) as f:
+        assert len(f.readlines()) == 2
+    for path in (filename, output, filename + '.solutions',
+                 filename + '.solutions.idx'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def test_no_pygame():
+    """ the solver command must work where pygame is not installed """
+    import subprocess
+    code = 'import sys, batch_solve; assert "pygame" not in sys.modules'
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
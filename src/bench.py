@@ -0,0 +1,299 @@
+""" Benchmarks of the hot paths: level loading, moves, player reachability,
+drawing, solving.
+Results are written as JSON, and can be compared with a saved baseline.
+Results are times in seconds, lower is better, except the outcome of each
+solved level, its status and push count, which must not change.
+Run from the src folder, eg:
+    python bench.py --output baseline.json
+    (change the code)
+    python bench.py --baseline baseline.json
+Exits with status 1 if a result is slower than its baseline by more
+than --tolerance, or if a level is not solved, or solved differently.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from constants import DIRN, DIRS, DIRE, DIRW
+from level import load_level_set
+
+
+LEVEL_SETS = ['../assets/levels_microban.txt', '../assets/maps_after_all.txt']
+RESOLUTIONS = [(400, 300), (800, 600), (1920, 1080)]
+AREAS = ['loader', 'move', 'reachable', 'draw', 'solver']
+# results that are outcomes, not times: compared for equality
+OUTCOMES = ('.status', '.pushes')
+
+
+def timed(fn, repeat):
+    """ median duration of repeat calls to fn, in seconds """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+def bench_loader(repeat=3):
+    """ time to parse each bundled level set """
+    results = {}
+    for path in LEVEL_SETS:
+        name = os.path.splitext(os.path.basename(path))[0]
+        results['load.%s' % name] = timed(lambda: load_level_set(path),
+                                          repeat)
+    return results
+
+
+def bench_move(levels, n_moves=20000, seed=0):
+    """ time per Level.move along random walks, and per undo back """
+    rng = random.Random(seed)
+    dirs = [rng.choice((DIRN, DIRS, DIRE, DIRW)) for _ in range(n_moves)]
+    per_level = n_moves // len(levels)
+    t_move = t_undo = 0
+    for i, level in enumerate(levels):
+        level.reset()
+        walk = dirs[i * per_level:(i + 1) * per_level]
+        t0 = time.perf_counter()
+        for d in walk:
+            level.move(d)
+        t1 = time.perf_counter()
+        while level.undo():
+            pass
+        t_undo += time.perf_counter() - t1
+        t_move += t1 - t0
+        level.reset()
+    n = per_level * len(levels)
+    return {'move.random_walk': t_move / n, 'move.undo': t_undo / n}
+
+
+def bench_reachable(n_calls=20000):
+    """ time per board.player_area call on an open 16x16 board """
+    from board import cells_to_bits, player_area
+    w = 16
+    walls = cells_to_bits([(y, x) for y in range(w) for x in range(w)
+                           if y in (0, w - 1) or x in (0, w - 1)], w)
+    boxes = cells_to_bits([(4, 4), (4, 5), (8, 8), (10, 3), (12, 12)], w)
+    free = ~(walls | boxes) & ((1 << w * w) - 1)
+    t0 = time.perf_counter()
+    for _ in range(n_calls):
+        player_area(w + 1, free, w)
+    return {'reachable.16x16': (time.perf_counter() - t0) / n_calls}
+
+
+def bench_draw(levels, n_frames=30, seed=0):
+    """ time per frame on an off-screen surface, per resolution:
+    draw.WxH redraws everything with draw_level, draw.view.WxH is what the
+    game does, a LevelView.draw after each Level.move.
+    Uses the dummy video driver unless another one is set.
+    """
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame as pg
+    from constants import SPR_ORDER
+    from level_draw import draw_level, load_spritesheet, LevelView
+    from level_draw import SpriteAtlas
+    from settings import SHEET_FILENAME, SPR_SIZE
+    pg.init()
+    pg.display.set_mode((1, 1))  # sprites are converted to its format
+    atlas = SpriteAtlas(load_spritesheet(SHEET_FILENAME, SPR_ORDER, SPR_SIZE))
+    rng = random.Random(seed)
+    results = {}
+    for w, h in RESOLUTIONS:
+        surf = pg.Surface((w, h))
+        draw_level(levels[0], surf, atlas)  # scale the sprites first
+        times = []
+        for i in range(n_frames):
+            level = levels[i % len(levels)]
+            t0 = time.perf_counter()
+            draw_level(level, surf, atlas)
+            times.append(time.perf_counter() - t0)
+        results['draw.%dx%d' % (w, h)] = statistics.median(times)
+        level = levels[0]
+        level.reset()
+        view = LevelView(atlas)
+        view.draw(level, surf)  # the background, once per level
+        times = []
+        for _ in range(n_frames):
+            dirs = [DIRN, DIRS, DIRE, DIRW]
+            rng.shuffle(dirs)
+            for d in dirs:
+                if level.move(d):
+                    break
+            t0 = time.perf_counter()
+            view.draw(level, surf)
+            times.append(time.perf_counter() - t0)
+        level.reset()
+        results['draw.view.%dx%d' % (w, h)] = statistics.median(times)
+    pg.quit()
+    return results
+
+
+def bench_solver(levels, max_seconds=10):
+    """ time to solve each level, from the start, and its outcome: a
+    pruning bug that fails fast must not look like a speed-up
+    """
+    from solver import solve
+    results = {}
+    for level in levels:
+        level.reset()
+        res = solve(level, max_seconds=max_seconds)
+        name = 'solve.%d' % level.level_num
+        results[name] = res.seconds
+        results[name + '.status'] = res.status
+        results[name + '.pushes'] = len(res.pushes) if res.solved else None
+    return results
+
+
+def run(areas=AREAS, n_solve=10, max_seconds=10):
+    """ return the dict of results of the benchmarks of areas """
+    levels = load_level_set(LEVEL_SETS[0])
+    results = {}
+    if 'loader' in areas:
+        results.update(bench_loader())
+    if 'move' in areas:
+        results.update(bench_move(levels))
+    if 'reachable' in areas:
+        results.update(bench_reachable())
+    if 'draw' in areas:
+        results.update(bench_draw(levels))
+    if 'solver' in areas:
+        results.update(bench_solver(levels[:n_solve], max_seconds))
+    return results
+
+
+def fmt(t):
+    """ seconds, as a string in a readable unit. Outcomes are left as is """
+    if not isinstance(t, float):
+        return str(t)
+    if t < 1e-3:
+        return '%.2f us' % (t * 1e6)
+    if t < 1:
+        return '%.2f ms' % (t * 1e3)
+    return '%.2f s' % t
+
+
+def compare(results, baseline, tolerance):
+    """ return [(name, baseline seconds, seconds, ratio)] of the results
+    slower than in baseline by more than tolerance, eg 0.1 for 10%,
+    and [(name, baseline, result, None)] of the outcomes that changed,
+    or that are not 'solved'.
+    Results missing from either side are ignored.
+    """
+    slower = []
+    for name, t in sorted(results.items()):
+        if name.endswith(OUTCOMES):
+            if name in baseline and (t != baseline[name] or name.endswith(
+                    '.status') and t != 'solved'):
+                slower.append((name, baseline[name], t, None))
+            continue
+        t0 = baseline.get(name)
+        if not t0:
+            continue
+        ratio = t / t0
+        if ratio > 1 + tolerance:
+            slower.append((name, t0, t, ratio))
+    return slower
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--only', choices=AREAS, nargs='+', default=AREAS,
+                   help='areas to benchmark')
+    p.add_argument('--solve-levels', type=int, default=10,
+                   help='number of microban levels to solve')
+    p.add_argument('--timeout', type=float, default=10,
+                   help='seconds allowed per level to solve')
+    p.add_argument('--output', default=None,
+                   help='write the results to this JSON file')
+    p.add_argument('--baseline', default=None,
+                   help='JSON file of earlier results to compare with')
+    p.add_argument('--tolerance', type=float, default=0.1,
+                   help='slowdown allowed before failing, 0.1 is 10%%')
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    results = run(args.only, args.solve_levels, args.timeout)
+    for name, t in sorted(results.items()):
+        print('%-24s %12s' % (name, fmt(t)))
+    if args.output:
+        out = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        slower = compare(results, baseline, args.tolerance)
+        for name, t0, t, ratio in slower:
+            if ratio is None:
+                print('changed: %s %s -> %s' % (name, t0, t))
+            else:
+                print('slower: %s %s -> %s (x%.2f)'
+                      % (name, fmt(t0), fmt(t), ratio))
+        return 1 if slower else 0
+    return 0
+
+
+################# TESTS ##################
+
+
+def test_compare():
+    baseline = {'a': 1.0, 'b': 1.0, 'c': 0}
+    results = {'a': 1.05, 'b': 1.5, 'c': 1.0, 'd': 9.0}
+    assert compare(results, baseline, 0.1) == [('b', 1.0, 1.5, 1.5)]
+    assert compare(results, baseline, 1) == []
+    # a level that fails fast is not a speed-up
+    baseline = {'solve.1': 1.0, 'solve.1.status': 'solved',
+                'solve.1.pushes': 8, 'solve.2.status': 'time limit'}
+    results = {'solve.1': 0.1, 'solve.1.status': 'unsolvable',
+               'solve.1.pushes': None, 'solve.2.status': 'time limit'}
+    assert compare(results, baseline, 0.1) == [
+        ('solve.1.pushes', 8, None, None),
+        ('solve.1.status', 'solved', 'unsolvable', None),
+        ('solve.2.status', 'time limit', 'time limit', None)]
+    results.update({'solve.1.status': 'solved', 'solve.1.pushes': 8,
+                    'solve.2.status': 'solved'})
+    assert compare(results, baseline, 0.1)[0][0] == 'solve.2.status'
+    del baseline['solve.2.status']
+    assert compare(results, baseline, 0.1) == []
+    assert fmt(2e-6) == '2.00 us' and fmt(0.5) == '500.00 ms'
+
+
+def test_bench_move():
+    levels = load_level_set(LEVEL_SETS[0])[:5]
+    hashes = [lv.hash for lv in levels]
+    results = bench_move(levels, n_moves=500)
+    assert set(results) == {'move.random_walk', 'move.undo'}
+    assert all(t > 0 for t in results.values())
+    assert [lv.hash for lv in levels] == hashes  # levels are reset
+
+
+def test_bench_reachable():
+    results = bench_reachable(n_calls=100)
+    assert list(results) == ['reachable.16x16']
+    assert 0 < results['reachable.16x16'] < 1e-2
+
+
+def test_bench_draw():
+    levels = load_level_set(LEVEL_SETS[0])[:3]
+    results = bench_draw(levels, n_frames=3)
+    assert len(results) == 2 * len(RESOLUTIONS)
+    assert 'draw.view.800x600' in results
+    assert all(t > 0 for t in results.values())
+    assert levels[0].n_moves == 0  # level is reset
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+""" Bitboard helpers for the level engine.
+A board of width w is flattened row by row: cell (y, x) has index y * w + x.
+A set of cells (walls, goals, boxes) is a python int with bit i set
+when cell i belongs to the set. Python ints have arbitrary width,
+so this works for any board size, but 16x16 boards fit in 256 bits.
+"""
+
+
+def to_index(pos, width):
+    """ (y, x) -> flat cell index """
+    y, x = pos
+    return y * width + x
+
+
+def to_pos(i, width):
+    """ flat cell index -> (y, x) """
+    return divmod(i, width)
+
+
+def cells_to_bits(positions, width):
+    """ list of (y, x) positions -> bitmask """
+    bits = 0
+    for pos in positions:
+        bits |= 1 << to_index(pos, width)
+    return bits
+
+
+def iter_bits(bits):
+    """ yield indices of set bits, lowest first """
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def bits_to_cells(bits, width):
+    """ bitmask -> list of (y, x) positions, in row-major order """
+    return [divmod(i, width) for i in iter_bits(bits)]
+
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+
+def reachable(start, free, w):
+    """ bitmask of cells reachable from cell index start, walking through
+    free cells, eg where the player can go without pushing a box.
+    free is the bitmask of cells that are neither walls nor boxes.
+    free must not touch the map borders, so that shifts never wrap.
+    The whole area grows by one step per loop, with no per-cell work.
+    """
+    reach = 1 << start
+    while True:
+        grown = reach | reach << 1 | reach >> 1 | reach << w | reach >> w
+        grown &= free
+        if grown == reach:
+            return reach
+        reach = grown
+
+
+def lowest(bits):
+    """ index of the lowest set bit """
+    return (bits & -bits).bit_length() - 1
+
+
+def player_area(player, free, w):
+    """ return the reach of the player, and its lowest cell index:
+    the normalized player position, the same wherever the player stands
+    in that area.
+    """
+    reach = reachable(player, free, w)
+    return reach, lowest(reach)
+
+
+################# TESTS ##################
+
+
+def test_cells_to_bits():
+    assert cells_to_bits([], 16) == 0
+    assert cells_to_bits([(0, 0), (0, 3)], 16) == 0b1001
+    assert cells_to_bits([(1, 0)], 16) == 1 << 16
+    cells = [(1, 2), (3, 4), (15, 15)]
+    assert bits_to_cells(cells_to_bits(cells, 16), 16) == cells
+
+
+def test_iter_bits():
+    assert list(iter_bits(0)) == []
+    assert list(iter_bits(0b10110)) == [1, 2, 4]
+    assert list(iter_bits(1 << 255)) == [255]
+    assert popcount(0b10110) == 3
+
+
+def test_reachable():
+    # 5x4 map, a wall splits the inside in two:
+    # #####
+    # #  ##
+    # ## .#
+    # #####
+    w = 5
+    border = [(y, x) for y in (0, 3) for x in range(5)]
+    walls = cells_to_bits(border + [(1, 0), (1, 3), (1, 4),
+                                    (2, 0), (2, 1), (2, 4)], w)
+    free = ~walls & ((1 << 20) - 1)
+    reach, norm = player_area(7, free, w)
+    assert bits_to_cells(reach, w) == [(1, 1), (1, 2), (2, 2), (2, 3)]
+    assert norm == 6
+    assert player_area(13, free, w) == (reach, norm)
+    # a box cuts the area
+    reach, norm = player_area(13, free & ~(1 << 12), w)
+    assert bits_to_cells(reach, w) == [(2, 3)] and norm == 13
+
+
+if __name__ == "__main__":
+    test_cells_to_bits()
+    test_iter_bits()
+    test_reachable()
@@ -1,10 +1,14 @@
 
 # outcomes of controller and scene manager
 OUT_NONE, OUT_QUIT, OUT_FSCR = 'none', 'quit', 'fullscreen'
+OUT_EXPOSE = 'expose'  # the window was uncovered: its content is lost
 
 # buttons
 BUPP, BDWN, BLFT, BRGT = 'up', 'down', 'left', 'right'
 BSLC, BRST, BMNU = 'select', 'reset', 'menu'
+BHNT = 'hint'
+BUND, BRDO = 'undo', 'redo'
+BPRF = 'profile'
 
 # colorkey of sprites 
 TRANSPARENT = (255, 0, 255)
@@ -22,3 +26,6 @@ SPR_ORDER = [
 
 # all possible directions
 DIRN, DIRS, DIRE, DIRW = 'N', 'S', 'E', 'W'
+
+# LURD notation of moves: lowercase for walking, uppercase for pushing
+LURD = {DIRW: 'l', DIRN: 'u', DIRE: 'r', DIRS: 'd'}
@@ -1,18 +1,24 @@
 import pygame as pg
 import settings
-from constants import OUT_FSCR, OUT_NONE, OUT_QUIT
+from constants import OUT_EXPOSE, OUT_FSCR, OUT_NONE, OUT_QUIT
+
+
+# the window shows again, and has to be drawn again
+EXPOSE_EVENTS = (pg.VIDEOEXPOSE, pg.WINDOWEXPOSED, pg.WINDOWRESTORED)
 
 
 class Controller:
     def __init__(self):
         self._bdown_events = set()  # buttons newly pressed this frame
         self._bpressed = set()  # buttons still pressed right now.
+        self._waited = []  # events that ended a wait(), for the next poll
     
     def poll(self):
         """ 
         toggle fullscreen with F11, 
         quit with alt-F4.
-        returns an outcome defined in constants. 
+        returns an outcome defined in constants, OUT_EXPOSE if the window
+        was uncovered or restored. 
         """
         kmap = settings.kmap
         valid_keys = settings.kmap.keys()
@@ -22,7 +28,9 @@ class Controller:
         self._bpressed = set([kmap[k] for k in valid_keys if kpressed[k]])
         # keys that were pressed just now. Also included in kpressed.
         self._bdown_events = set()
-        for event in pg.event.get():
+        events, self._waited = self._waited + pg.event.get(), []
+        outcome = OUT_NONE
+        for event in events:
             if event.type == pg.QUIT:
                 return OUT_QUIT
             if event.type == pg.KEYDOWN:
@@ -32,8 +40,21 @@ class Controller:
                     self._bdown_events.add(kmap[event.key])
                 elif event.key == pg.K_F11:
                     return OUT_FSCR
-        return OUT_NONE
+            if event.type in EXPOSE_EVENTS:
+                outcome = OUT_EXPOSE  # after the keys of this frame
+        return outcome
     
+    def wait(self, ms=None):
+        """ sleep until an event comes, or for at most ms milliseconds.
+        The event is kept for the next poll().
+        """
+        if ms is None:
+            event = pg.event.wait()
+        else:
+            event = pg.event.wait(max(1, ms))  # 0 would wait for ever
+        if event.type != pg.NOEVENT:
+            self._waited.append(event)
+
     def btn_ispressed(self, btn):
         return btn in self._bpressed
     
@@ -41,4 +62,21 @@ class Controller:
         return btn in self._bdown_events
     
 
-controller = Controller()
\ No newline at end of file
+controller = Controller()
+
+
+################# TESTS ##################
+
+
+def test_poll_expose():
+    import os
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    pg.init()
+    pg.display.set_mode((10, 10))
+    pg.event.get()
+    ctrl = Controller()
+    assert ctrl.poll() == OUT_NONE
+    pg.event.post(pg.event.Event(pg.WINDOWEXPOSED))
+    assert ctrl.poll() == OUT_EXPOSE
+    assert ctrl.poll() == OUT_NONE
+    pg.quit()
@@ -0,0 +1,247 @@
+""" Static deadlock analysis, run once per level at load time.
+Dead squares are floor cells from which a box can never reach any goal.
+They are found by pulling a box backwards from every goal: a cell the box
+can be pulled to is live, and every other floor cell is dead: this marks
+the walls without goals along them, and dead-end corridors without goals.
+Freeze deadlocks depend on box positions, so they are checked per push,
+but only against 2x2 squares precomputed around the pushed box.
+Corridor deadlocks are checked per push too: two boxes in a one-wide
+corridor without goals, with the player outside of the stretch between
+them, can never leave it.
+Levels can have more boxes than goals. The surplus boxes may sit on dead
+squares or stay frozen, so such a level is only deadlocked when more
+boxes than the surplus can never reach a goal.
+"""
+from board import iter_bits, popcount
+
+
+def dead_squares(walls, goals, w, h):
+    """ bitmask of floor cells a box can never be pushed from to a goal.
+    A pull moves the box from c to c + delta, with the player going from
+    c + delta to c + 2 * delta, so both cells must be floor.
+    """
+    n = w * h
+    live = goals
+    frontier = list(iter_bits(goals))
+    while frontier:
+        nxt = []
+        for c in frontier:
+            for delta in (-w, w, -1, 1):
+                c1, c2 = c + delta, c + 2 * delta
+                if not 0 <= c2 < n:
+                    continue
+                if walls >> c1 & 1 or walls >> c2 & 1 or live >> c1 & 1:
+                    continue
+                live |= 1 << c1
+                nxt.append(c1)
+        frontier = nxt
+    floor = ~walls & ((1 << n) - 1)
+    return floor & ~live
+
+
+def freeze_squares(walls, w, h):
+    """ list mapping each cell index to the bitmasks of the 2x2 squares
+    that contain it. Squares made of walls only are left out.
+    """
+    squares = [[] for _ in range(w * h)]
+    for y in range(h - 1):
+        for x in range(w - 1):
+            i = y * w + x
+            sq = 1 << i | 1 << (i + 1) | 1 << (i + w) | 1 << (i + w + 1)
+            if sq & walls == sq:
+                continue
+            for c in (i, i + 1, i + w, i + w + 1):
+                squares[c].append(sq)
+    return squares
+
+
+def corridor_segments(walls, goals, w, h):
+    """ list mapping each cell index to the bitmask of the one-wide
+    corridor without goals it is in, 0 if none. A corridor is a row of
+    floor cells with walls above and below, or a column of floor cells
+    with walls left and right: a box in it can only be pushed along it.
+    """
+    n = w * h
+    floor = ~walls & ((1 << n) - 1)
+    segments = [0] * n
+    for tunnel, step in ((floor & walls << w & walls >> w, 1),
+                         (floor & walls << 1 & walls >> 1, w)):
+        for c in iter_bits(tunnel):
+            if tunnel >> (c - step) & 1:
+                continue  # not the first cell of its corridor
+            cells = []
+            while tunnel >> c & 1:
+                cells.append(c)
+                c += step
+            seg = sum(1 << c for c in cells)
+            if len(cells) > 1 and not seg & goals:
+                for c in cells:
+                    segments[c] = seg
+    return segments
+
+
+def corridor_stuck(cell, player, boxes, segments):
+    """ bitmask of the boxes that can never leave the corridor of the box
+    at cell, the player being on the cell next to it: that box and the
+    boxes beyond it, if any. Each could only leave by being pushed away
+    from the next one, from the stretch between them, which the player can
+    not get into. 0 if there is no box beyond.
+    segments is the list returned by corridor_segments.
+    """
+    seg = segments[cell]
+    if not seg:
+        return 0
+    others = boxes & seg & ~(1 << cell)
+    if player < cell:
+        beyond = others >> cell << cell
+    else:
+        beyond = others & ((1 << cell) - 1)
+    return beyond | 1 << cell if beyond else 0
+
+
+def is_frozen(cell, boxes, walls, goals, squares):
+    """ true if the box at cell completes a 2x2 square of walls and boxes
+    holding a box off its goal. None of these boxes can ever move again.
+    squares is the list returned by freeze_squares.
+    """
+    blocked = walls | boxes
+    for sq in squares[cell]:
+        if blocked & sq == sq and boxes & sq & ~goals:
+            return True
+    return False
+
+
+def stuck_boxes(boxes, walls, goals, dead, squares):
+    """ bitmask of the boxes that can never get to a goal: on a dead
+    square, or off goal in a 2x2 square of walls and boxes.
+    """
+    stuck = boxes & dead
+    blocked = walls | boxes
+    for b in iter_bits(boxes & ~goals & ~dead):
+        for sq in squares[b]:
+            if blocked & sq == sq:
+                stuck |= 1 << b
+                break
+    return stuck
+
+
+def is_deadlocked(boxes, walls, goals, dead, squares, surplus=0):
+    """ true if more than surplus boxes are on a dead square, or frozen
+    off goal. surplus is how many more boxes than goals the level has.
+    Scans boxes only, not the board.
+    """
+    if surplus:
+        stuck = stuck_boxes(boxes, walls, goals, dead, squares)
+        return popcount(stuck) > surplus
+    if boxes & dead:
+        return True
+    return any(is_frozen(b, boxes, walls, goals, squares)
+               for b in iter_bits(boxes))
+
+
+################# TESTS ##################
+
+
+def _bits(rows):
+    """ bitmask of '#' cells, of '.' cells and of '$' cells in rows """
+    w = len(rows[0])
+    walls = goals = boxes = 0
+    for y, row in enumerate(rows):
+        for x, c in enumerate(row):
+            bit = 1 << (y * w + x)
+            walls |= bit if c == '#' else 0
+            goals |= bit if c == '.' else 0
+            boxes |= bit if c == '$' else 0
+    return walls, goals, boxes
+
+
+def test_dead_squares():
+    rows = [
+        "######",
+        "#    #",
+        "# .  #",
+        "#    #",
+        "######",
+    ]
+    w, h = 6, 5
+    walls, goals, _ = _bits(rows)
+    dead = dead_squares(walls, goals, w, h)
+    # a box can only be pulled from the goal (14) to its right (15):
+    # pulling it anywhere else needs the player to stand in a wall
+    for i in (7, 8, 9, 10, 13, 16, 19, 20, 21, 22):
+        assert dead >> i & 1, i
+    assert not dead >> 14 & 1 and not dead >> 15 & 1
+    assert not dead & walls
+
+
+def test_freeze():
+    rows = [
+        "######",
+        "#$$  #",
+        "# $$ #",
+        "#. ..#",
+        "######",
+    ]
+    w, h = 6, 5
+    walls, goals, boxes = _bits(rows)
+    squares = freeze_squares(walls, w, h)
+    assert len(squares[7]) == 4 and squares[0] == [squares[7][0]]
+    assert is_frozen(7, boxes, walls, goals, squares)  # 2 boxes under walls
+    assert not is_frozen(14, boxes, walls, goals, squares)  # can go down
+    assert is_deadlocked(boxes, walls, goals, 0, squares)
+    assert not is_deadlocked(1 << 14, walls, goals, 0, squares)
+
+
+def test_corridor():
+    rows = [
+        "#########",
+        "#       #",
+        "# ##### #",
+        "#   .   #",
+        "# ##### #",
+        "#       #",
+        "#########",
+    ]
+    w, h = 9, 7
+    walls, goals, _ = _bits(rows)
+    segments = corridor_segments(walls, goals, w, h)
+    # the top row, between the walls above and below it
+    assert segments[11] == sum(1 << c for c in range(11, 16))
+    assert segments[10] == segments[16] == 0
+    assert segments[30] == 0  # the middle row has a goal: boxes may stay
+    assert segments[49] == segments[47]
+    # box pushed right to 12, towards a box at 14: both stuck
+    boxes = 1 << 12 | 1 << 14
+    assert corridor_stuck(12, 11, boxes, segments) == boxes
+    # pushed left to 12, the player at 13 can still push each one out
+    assert corridor_stuck(12, 13, boxes, segments) == 0
+    # pushed left to 14: the player is beyond both
+    assert corridor_stuck(14, 15, boxes, segments) == boxes
+    assert corridor_stuck(12, 11, 1 << 12, segments) == 0
+    assert corridor_stuck(30, 29, 1 << 30 | 1 << 32, segments) == 0
+
+
+def test_surplus():
+    rows = [
+        "######",
+        "#$$  #",
+        "# $$ #",
+        "#. . #",
+        "######",
+    ]
+    w, h = 6, 5
+    walls, goals, boxes = _bits(rows)
+    squares = freeze_squares(walls, w, h)
+    dead = dead_squares(walls, goals, w, h)
+    assert stuck_boxes(boxes, walls, goals, dead, squares) == 1 << 7 | 1 << 8
+    # 4 boxes for 2 goals: the 2 frozen boxes are the ones left over
+    assert not is_deadlocked(boxes, walls, goals, dead, squares, surplus=2)
+    assert is_deadlocked(boxes, walls, goals, dead, squares, surplus=1)
+    assert is_deadlocked(boxes, walls, goals, dead, squares)
+
+
+if __name__ == "__main__":
+    test_dead_squares()
+    test_freeze()
+    test_corridor()
+    test_surplus()
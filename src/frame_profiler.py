@@ -0,0 +1,148 @@
+""" Per-frame timing of the main loop phases: input, logic, draw, text, flip.
+The main loop and scenes wrap their work in profiler.phase(name). Phases
+can nest: time spent in an inner phase is not counted in the outer one.
+While enabled, the time of each phase in the last frames is kept to give
+rolling percentiles, and each phase run is kept as a trace event, dumped
+in Chrome's trace event format (open it in chrome://tracing or Perfetto).
+Disabled, phase() costs a method call and returns a shared null context.
+"""
+from collections import deque
+from contextlib import contextmanager, nullcontext
+import json
+import time
+
+
+PHASES = ['input', 'logic', 'draw', 'text', 'flip']
+
+
+def percentile(values, p):
+    """ p-th percentile of values, by the nearest-rank method """
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    k = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[k]
+
+
+class FrameProfiler:
+    """ Rolling per-phase frame times, in milliseconds.
+    frames is how many frames the percentiles are computed over.
+    max_events bounds the trace kept for dump().
+    clock returns the time in seconds, eg a fake one in tests.
+    """
+
+    def __init__(self, frames=300, max_events=100000,
+                 clock=time.perf_counter):
+        self.enabled = False
+        self._clock = clock
+        self._history = {p: deque(maxlen=frames) for p in PHASES}
+        self._events = deque(maxlen=max_events)  # (name, start, duration)
+        self._frame = {p: 0 for p in PHASES}  # ms in each phase, this frame
+        self._stack = []  # phases being timed, innermost last
+        self._last = 0  # when the innermost phase last resumed
+        self._null = nullcontext()
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self._stack = []
+
+    def phase(self, name):
+        """ context manager timing name, if enabled """
+        if not self.enabled:
+            return self._null
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        start = self._clock()
+        if self._stack:  # pause the outer phase
+            outer = self._stack[-1]
+            self._frame[outer] += (start - self._last) * 1000
+        self._stack.append(name)
+        self._last = start
+        try:
+            yield
+        finally:
+            end = self._clock()
+            self._frame[name] += (end - self._last) * 1000
+            self._stack.pop()
+            self._last = end
+            self._events.append((name, start, end - start))
+
+    def end_frame(self):
+        """ file the phase times of the frame that just ended """
+        if not self.enabled:
+            return
+        for p in PHASES:
+            self._history[p].append(self._frame[p])
+            self._frame[p] = 0
+
+    def stats(self):
+        """ list of (phase, p50 ms, p99 ms) over the last frames """
+        return [(p, percentile(self._history[p], 50),
+                 percentile(self._history[p], 99)) for p in PHASES]
+
+    def summary(self):
+        """ stats as a few lines of text, for an overlay """
+        lines = ['%-5s %5.1f %5.1f' % s for s in self.stats()]
+        return '\n'.join(['ms    p50   p99'] + lines)
+
+    def dump(self, filename):
+        """ write the trace events kept so far. return false if none. """
+        if not self._events:
+            return False
+        t0 = self._events[0][1]
+        events = [{'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                   'ts': round((start - t0) * 1e6),
+                   'dur': round(dur * 1e6)}
+                  for name, start, dur in self._events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events}, f)
+        return True
+
+
+profiler = FrameProfiler()
+
+
+################# TESTS ##################
+
+
+def test_frame_profiler():
+    import os
+    now = [0.0]  # fake clock, advanced by hand: no sleeps to depend on
+    prof = FrameProfiler(frames=10, clock=lambda: now[0])
+    with prof.phase('logic'):  # disabled: nothing recorded
+        pass
+    prof.end_frame()
+    assert not prof._events and not prof._history['logic']
+    prof.toggle()
+    for _ in range(3):
+        with prof.phase('logic'):
+            now[0] += 0.002
+            with prof.phase('draw'):
+                now[0] += 0.004
+            now[0] += 0.001
+        prof.end_frame()
+    stats = {p: (p50, p99) for p, p50, p99 in prof.stats()}
+    # draw time is not counted in logic
+    assert abs(stats['logic'][0] - 3) < 1e-6
+    assert abs(stats['draw'][0] - 4) < 1e-6
+    assert stats['input'] == (0, 0)
+    assert 'logic' in prof.summary()
+    filename = 'frames.trace.test'
+    assert prof.dump(filename)
+    with open(filename) as f:
+        events = json.load(f)['traceEvents']
+    assert [e['name'] for e in events[:2]] == ['draw', 'logic']
+    os.remove(filename)
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50 and percentile(values, 99) == 99
+    assert percentile([], 50) == 0 and percentile([7], 99) == 7
+
+
+if __name__ == "__main__":
+    test_frame_profiler()
+    test_percentile()
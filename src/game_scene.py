@@ -4,36 +4,64 @@ Can also pause game and go to main menu, passing an option to resume game.
 """
 import ptext
 from pview import T
-from constants import BDWN, BUPP, BLFT, BRGT, BRST, BMNU
+from constants import BDWN, BUPP, BLFT, BRGT, BRST, BMNU, BHNT, BUND, BRDO
 from constants import SPR_ORDER, DIRN, DIRS, DIRE, DIRW
 from controls import controller
-from level_draw import load_spritesheet, draw_level
+from frame_profiler import profiler
+from hint import HintEngine
+from level_draw import load_spritesheet, LevelView, SpriteAtlas
 import pview
 import pygame as pg
 from scene import Scene, SCN_GAME, SCN_MENU
 from settings import SHEET_FILENAME, SPR_SIZE, BASE_RES
+from settings import HINT_SECONDS, HINT_BLINK_MS, PROFILE_REFRESH_MS
+from settings import IDLE_POLL_MS
+from solver import UNSOLVABLE
 
 
 class GameScene(Scene):
 
-    def __init__(self, levels):
+    def __init__(self, levels, store=None):
+        """ store is an optional SolutionStore, to answer hints faster """
         # load spritesheet
         self.sprites = load_spritesheet(SHEET_FILENAME, SPR_ORDER, SPR_SIZE)
+        self.view = LevelView(SpriteAtlas(self.sprites))
+        self._hud = None  # HUD content on screen
         self.levels = levels
         self.level = levels[0]
+        self.hints = HintEngine(store, HINT_SECONDS)
+        self._hint = None  # (box position, direction) to show
+        self._hint_txt = ''  # hint status shown in the HUD
+        self._hint_ms = 0  # time since the hint showed up, for blinking
+        self._prof_txt = ''  # frame time stats shown in the HUD
+        self._prof_ms = 0  # time since the stats were refreshed
+        self._drawn = False  # whether the screen shows the current state
 
     def tick(self, ms):
         """ process player inputs and draw """
+        moved = False
         if controller.btn_event(BUPP):
-            self.level.move(DIRN)
+            moved |= self.level.move(DIRN)
         if controller.btn_event(BDWN):
-            self.level.move(DIRS)
+            moved |= self.level.move(DIRS)
         if controller.btn_event(BLFT):
-            self.level.move(DIRW)
+            moved |= self.level.move(DIRW)
         if controller.btn_event(BRGT):
-            self.level.move(DIRE)
+            moved |= self.level.move(DIRE)
+        if controller.btn_event(BUND):
+            moved |= self.level.undo()
+        if controller.btn_event(BRDO):
+            moved |= self.level.redo()
         if controller.btn_event(BRST):
             self.level.reset()
+            moved = True
+        if moved:  # pending or shown hint is stale
+            self._clear_hint()
+        if controller.btn_event(BHNT):
+            self.hints.request(self.level)
+            self._hint_txt = 'Thinking...'
+        self._poll_hint(ms)
+        self._update_profile(ms)
         if controller.btn_event(BMNU):
             return SCN_MENU, {'current_level': self.level.level_num}
 
@@ -44,8 +72,53 @@ class GameScene(Scene):
         self._draw()
         return None, {}
 
+    def wait_ms(self):
+        """ frames only while the hint arrow blinks or the profiler runs """
+        if not self._drawn or profiler.enabled:
+            return 0
+        if self._hint:  # until the arrow shows or hides
+            return HINT_BLINK_MS - self._hint_ms % HINT_BLINK_MS
+        if self.hints.pending():
+            return IDLE_POLL_MS
+        return None
+
+    def _clear_hint(self):
+        self.hints.cancel()
+        self._hint = None
+        self._hint_txt = ''
+
+    def _poll_hint(self, ms):
+        """ pick up the hint once the engine is done """
+        self._hint_ms += ms
+        res = self.hints.poll()
+        if res is None:
+            return
+        self._hint, status = res
+        self._hint_ms = 0
+        if self._hint is not None:
+            self._hint_txt = ''
+        elif status == UNSOLVABLE:
+            self._hint_txt = 'No solution\nfrom here'
+        else:
+            self._hint_txt = 'No hint found'
+
+    def _update_profile(self, ms):
+        """ refresh the frame time stats now and then, not every frame """
+        if not profiler.enabled:
+            self._prof_txt = ''
+            return
+        self._prof_ms += ms
+        if self._prof_ms >= PROFILE_REFRESH_MS or not self._prof_txt:
+            self._prof_txt = profiler.summary()
+            self._prof_ms = 0
+
+    def pause(self):
+        self._clear_hint()
+
     def resume(self, **kwargs):
         """ Scene callback. Called from the menu scene via scene manager. """
+        self.view.invalidate()  # the menu drew over the screen
+        self._drawn = False
         if kwargs.get('level'):
             level_num = kwargs['level']
             self.level = self.levels[level_num % len(self.levels)]
@@ -54,26 +127,65 @@ class GameScene(Scene):
             pass
 
     def _draw(self):
-        # TODO: DirtySprite for player and fixed surf for bg
-        pview.fill((0, 155, 155))  # unnecessary?
-        draw_level(self.level, pview.screen, self.sprites)
-        # pview.screen.blit(self.bg, (0, 0))
-        # TODO: right-side HUD tracking steps and current level number
-        x = BASE_RES[1] + 10
-        y = 10
-        ptext.draw('Level %d' % self.level.level_num, T(x, y), fontsize=T(40))
-        w, h = BASE_RES
-        txt = 'R: rest level\nF11: toggle fullscreen\nEsc: menu'
-        ptext.draw(txt, T(h+20, h-80), fontsize=T(20))
+        """ repaint what changed since the last frame, and push only
+        those rects to the display.
+        """
+        screen = pview.screen
+        arrow = None
+        if self._hint and (self._hint_ms // HINT_BLINK_MS) % 2 == 0:
+            arrow = self._hint
+        # the level fits in the square on the left, the HUD is on its right
+        sw, sh = screen.get_size()
+        side = min(sw, sh)
+        play = screen.subsurface(pg.Rect(0, 0, side, side))
+        with profiler.phase('draw'):
+            rects = self.view.draw(self.level, play, arrow)
+
+        # right-side HUD, redrawn when its content changes
+        hud = (self.level.level_num, self.level.deadlocked, self._hint_txt,
+               self._prof_txt)
+        if self.view.rebuilt or hud != self._hud:
+            self._hud = hud
+            hud_rect = pg.Rect(side, 0, sw - side, sh)
+            screen.fill((0, 0, 0), hud_rect)
+            with profiler.phase('text'):
+                self._draw_hud()
+            rects.append(hud_rect)
 
-        pg.display.flip()
+        with profiler.phase('flip'):
+            if self.view.rebuilt:
+                pg.display.flip()
+            elif rects:
+                pg.display.update(rects)
+
+        self._drawn = True
 
         # TODO: level navigator menu (can replay any unlocked one)
 
+    def _draw_hud(self):
+        # TODO: right-side HUD tracking steps
+        x = BASE_RES[1] + 10
+        y = 10
+        ptext.draw('Level %d' % self.level.level_num, T(x, y),
+                   fontsize=T(40))
+        if self.level.deadlocked:
+            ptext.draw('Stuck!\nR to reset', T(x, y + 60),
+                       fontsize=T(30), color=(230, 90, 60))
+        elif self._hint_txt:
+            ptext.draw(self._hint_txt, T(x, y + 60), fontsize=T(20))
+        if self._prof_txt:
+            ptext.draw(self._prof_txt, T(x, y + 190), fontsize=T(16),
+                       sysfontname='monospace', color=(160, 230, 160))
+        w, h = BASE_RES
+        txt = ('Z/Y: undo/redo\nH: hint\nR: rest level\n'
+               'F11: toggle fullscreen\nF3: frame times\nEsc: menu')
+        ptext.draw(txt, T(h+20, h-140), fontsize=T(20))
+
     def redraw(self):
-        # TODO: recompute/redraw bg
-        # self._draw()
-        pass
+        """ resolution changed, or the window was uncovered: rebuild the
+        background at the next tick """
+        self.view.invalidate()
+        self._drawn = False
 
 
 if __name__ == "__main__":
@@ -93,6 +205,7 @@ if __name__ == "__main__":
             break
         elif outcome == OUT_FSCR:
             pview.toggle_fullscreen()
+            ptext.set_scale(pview.f)
             scene.redraw()
 
         next_scene_id, kwargs = scene.tick(ms)
@@ -0,0 +1,189 @@
+""" Push distances and lower bounds on the pushes left to solve a level.
+push_distances gives, for each goal, the number of pushes a lone box needs
+to reach it from each cell. It is computed once per level by pulling a box
+backwards from the goal.
+Matching pairs boxes with goals at minimum total push distance (hungarian
+algorithm). Its cost is an admissible heuristic, and it is updated in
+O(n^2) when a single box moves, instead of being solved again in O(n^3).
+"""
+from copy import copy
+from board import iter_bits
+
+
+UNREACHABLE = 10 ** 6  # push distance when a box can not reach a goal
+
+
+def push_distances(walls, goals, w, h):
+    """ list with, for each goal in cell order, a list mapping each cell
+    index to the pushes needed to bring a box from that cell to the goal,
+    ignoring other boxes. UNREACHABLE if the box can never get there.
+    """
+    n = w * h
+    tables = []
+    for g in iter_bits(goals):
+        dist = [UNREACHABLE] * n
+        dist[g] = 0
+        frontier = [g]
+        k = 0
+        while frontier:
+            k += 1
+            nxt = []
+            for c in frontier:
+                for delta in (-w, w, -1, 1):
+                    c1, c2 = c + delta, c + 2 * delta
+                    if not 0 <= c2 < n or dist[c1] != UNREACHABLE:
+                        continue
+                    if walls >> c1 & 1 or walls >> c2 & 1:
+                        continue
+                    dist[c1] = k
+                    nxt.append(c1)
+            frontier = nxt
+        tables.append(dist)
+    return tables
+
+
+def nearest_goal_distances(tables):
+    """ list mapping each cell index to its push distance to the closest
+    goal. Summed over boxes, a cheaper and weaker bound than Matching.
+    Only a lower bound when there are as many boxes as goals.
+    """
+    return [min(col) for col in zip(*tables)]
+
+
+class Matching:
+    """ Minimum cost assignment of boxes to goals.
+    Rows are goals, padded with zero-cost dummy rows so that there are
+    as many rows as boxes, and columns are boxes.
+    u, v are the dual potentials, and p[j] is the row assigned to column j.
+    Arrays are 1-based, index 0 being the hungarian algorithm's sentinel.
+    """
+
+    def __init__(self, tables, cells):
+        """ tables is the list returned by push_distances.
+        cells is the list of box cell indices.
+        """
+        self.tables = tables
+        self.cells = [None] + list(cells)
+        self.n = len(cells)
+        self.u = [0] * (self.n + 1)
+        self.v = [0] * (self.n + 1)
+        self.p = [0] * (self.n + 1)
+        for i in range(1, self.n + 1):
+            self._augment(i)
+
+    def _cost(self, i, j):
+        if i > len(self.tables):
+            return 0  # dummy goal, for boxes left over
+        return self.tables[i - 1][self.cells[j]]
+
+    def _augment(self, i):
+        """ assign row i, which must be free, along a shortest augmenting
+        path, keeping the potentials feasible.
+        """
+        n, u, v, p, cost = self.n, self.u, self.v, self.p, self._cost
+        p[0] = i
+        j0 = 0
+        minv = [UNREACHABLE * (n + 1)] * (n + 1)
+        way = [0] * (n + 1)
+        used = [False] * (n + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            delta = UNREACHABLE * (n + 1)
+            j1 = 0
+            for j in range(1, n + 1):
+                if not used[j]:
+                    cur = cost(i0, j) - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(n + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    @property
+    def cost(self):
+        """ total push distance of the assignment.
+        UNREACHABLE or more when some goal can not get a box.
+        """
+        return sum(self._cost(self.p[j], j) for j in range(1, self.n + 1))
+
+    def moved(self, cell, new_cell):
+        """ return a new Matching where the box at cell is at new_cell.
+        Only that box's column changes: its potential is lowered back to
+        feasibility, its goal is freed, then reassigned by one augmentation.
+        """
+        m = copy(self)
+        m.cells, m.u, m.v, m.p = self.cells[:], self.u[:], self.v[:], self.p[:]
+        j = m.cells.index(cell)
+        m.cells[j] = new_cell
+        m.v[j] = min(m._cost(i, j) - m.u[i] for i in range(1, m.n + 1))
+        i = m.p[j]
+        m.p[j] = 0
+        m._augment(i)
+        return m
+
+
+################# TESTS ##################
+
+
+def _brute_force(tables, cells):
+    from itertools import permutations
+    best = None
+    for perm in permutations(cells, len(tables)):
+        c = sum(t[b] for t, b in zip(tables, perm))
+        best = c if best is None else min(best, c)
+    return best
+
+
+def test_push_distances():
+    # 6x3 map, a corridor of 4 cells with a goal at index 8
+    w, h = 6, 3
+    walls = 0b111111 | 0b100001 << 6 | 0b111111 << 12
+    goals = 1 << 8
+    tables = push_distances(walls, goals, w, h)
+    assert len(tables) == 1
+    dist = tables[0]
+    assert dist[8] == 0 and dist[9] == 1
+    assert dist[7] == UNREACHABLE  # player can not get left of it to pull
+    assert dist[10] == UNREACHABLE  # against the right wall
+    assert nearest_goal_distances(tables)[9] == 1
+
+
+def test_matching():
+    import random
+    rng = random.Random(1)
+    for _ in range(200):
+        n_goals = rng.randint(1, 4)
+        n_boxes = rng.randint(n_goals, 5)
+        tables = [[rng.randint(0, 9) for _ in range(10)]
+                  for _ in range(n_goals)]
+        cells = rng.sample(range(10), n_boxes)
+        m = Matching(tables, cells)
+        assert m.cost == _brute_force(tables, cells)
+        # move a box to a free cell, and check the incremental update
+        free = [c for c in range(10) if c not in cells]
+        if free:
+            old, new = rng.choice(cells), rng.choice(free)
+            m2 = m.moved(old, new)
+            cells2 = [new if c == old else c for c in cells]
+            assert m2.cost == _brute_force(tables, cells2)
+            assert m.cost == _brute_force(tables, cells)  # m is unchanged
+
+
+if __name__ == "__main__":
+    test_push_distances()
+    test_matching()
@@ -0,0 +1,168 @@
+""" Hints computed off the game loop.
+HintEngine runs searches in a worker thread. The scene submits the current
+state of its level with request(), then calls poll() every tick until the
+hint is ready. Moving the player makes the pending request stale: cancel()
+stops the search.
+Every state along a solution found by a previous request is remembered,
+with the pushes that solve the level from there. As long as the player
+follows the hints, the next ones are instant. Off that path, the search
+starts over from the player's state, and ends as soon as it gets back to
+one of these states. That is all that is kept of earlier searches: the
+other states they visited are neither solved nor known to be dead, so
+they can not cut a later search, and the new search starts from another
+root with other costs.
+"""
+import logging
+import queue
+import threading
+from board import to_pos
+from solver import solve, state_key, ANY, SOLVED
+
+
+class HintEngine:
+    """ Worker thread answering hint requests one at a time.
+    A hint is a push (box (y,x), direction), or None when the level
+    can not be solved from the current state, or the search gave up.
+    store is an optional solution_db.SolutionStore to look up first.
+    """
+
+    def __init__(self, store=None, max_seconds=10):
+        self.store = store
+        self.max_seconds = max_seconds
+        self._known = {}  # state key -> [(box index, direction)] to solve
+        self._digest = None  # level of the states in _known
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._req_id = 0  # id of the latest request
+        self._cancel = threading.Event()
+        self._cancel.set()  # no request yet
+        self._result = None  # (request id, hint, status)
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='hints')
+        self._thread.start()
+
+    def request(self, level):
+        """ ask for a hint for the current state of level.
+        Supersedes any pending request. Returns immediately.
+        """
+        self.cancel()
+        with self._lock:
+            self._req_id += 1
+            self._cancel = threading.Event()
+            # a clone keeps the state, and shares the level layout
+            self._requests.put((self._req_id, level.clone(), self._cancel))
+
+    def cancel(self):
+        """ forget the pending request, and stop its search if running """
+        with self._lock:
+            self._cancel.set()
+            self._result = None
+            self._req_id += 1
+
+    def poll(self):
+        """ return (hint, status) once the latest request is answered,
+        None otherwise. status is one of the solver statuses.
+        """
+        with self._lock:
+            r = self._result
+            if r is None or r[0] != self._req_id:
+                return None
+            self._result = None
+            return r[1], r[2]
+
+    def pending(self):
+        """ true from a request until poll() returns its answer """
+        with self._lock:
+            return not self._cancel.is_set() or self._result is not None
+
+    def stop(self):
+        """ end the worker thread """
+        self.cancel()
+        self._requests.put(None)
+        self._thread.join()
+
+    def _run(self):
+        log = logging.getLogger('game')
+        while True:
+            req = self._requests.get()
+            if req is None:
+                return
+            req_id, level, cancel = req
+            if cancel.is_set():
+                continue
+            hint, status = self._hint(level, cancel)
+            log.debug('hint for level %d: %s %s'
+                      % (level.level_num, status, hint))
+            with self._lock:
+                if req_id == self._req_id:
+                    self._result = (req_id, hint, status)
+                    self._cancel.set()  # request done
+
+    def _hint(self, level, cancel):
+        digest = level.digest()
+        if digest != self._digest:
+            self._known = {}
+            self._digest = digest
+        w = level.width
+        rest = self._known.get(state_key(level, level.box_bits,
+                                         level.player_idx))
+        if rest is not None:
+            b, d = rest[0]
+            return (to_pos(b, w), d), SOLVED
+        if self.store is not None:
+            hint = self.store.hint(level)
+            if hint is not None:
+                return hint, SOLVED
+        res = solve(level, max_seconds=self.max_seconds, cancel=cancel,
+                    objective=ANY,  # any solution is a good hint
+                    finishes=self._known)
+        if not res.solved or not res.pushes:
+            return None, res.status
+        # remember the rest of the solution from every state along it
+        path = [(y * w + x, d) for (y, x), d in res.pushes]
+        boxes, player = level.box_bits, level.player_idx
+        for i, (b, d) in enumerate(path):
+            self._known[state_key(level, boxes, player)] = path[i:]
+            boxes ^= 1 << b | 1 << (b + level.deltas[d])
+            player = b
+        return res.pushes[0], SOLVED
+
+
+################# TESTS ##################
+
+
+def test_hint_engine():
+    import time
+    from constants import DIRE
+    from level import build_level_from_tiles
+    rows = ['#######', '#@$  .#', '#######']
+    level = build_level_from_tiles([list(r) for r in rows], 16)
+    engine = HintEngine()
+    engine.request(level)
+    t0 = time.time()
+    res = None
+    while res is None and time.time() - t0 < 5:
+        res = engine.poll()
+        time.sleep(0.01)
+    assert res == (((1, 2), DIRE), SOLVED)
+    assert engine.poll() is None  # answered once
+    assert not engine.pending()
+    level.move(DIRE)
+    engine.request(level)  # on the solution path: answered from memory
+    t0 = time.time()
+    res = None
+    while res is None and time.time() - t0 < 5:
+        res = engine.poll()
+        time.sleep(0.01)
+    assert res == (((1, 3), DIRE), SOLVED)
+    assert len(engine._known) == 3  # the state before each push
+    engine.request(level)
+    assert engine.pending()
+    engine.cancel()  # stale request: never answered
+    time.sleep(0.05)
+    assert engine.poll() is None
+    engine.stop()
+
+
+if __name__ == "__main__":
+    test_hint_engine()
@@ -1,7 +1,18 @@
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property
+import hashlib
+from itertools import chain, islice
 import os
-from copy import deepcopy
-from constants import DIRN, DIRS, DIRE, DIRW
+from board import (bits_to_cells, cells_to_bits, iter_bits, lowest,
+                   popcount, reachable, to_index, to_pos)
+from constants import DIRN, DIRS, DIRE, DIRW, LURD
+from deadlock import (corridor_segments, corridor_stuck, dead_squares,
+                      freeze_squares, is_deadlocked, is_frozen, stuck_boxes)
+from heuristic import push_distances, UNREACHABLE
 import logging
+from zobrist import keys_for
 
 
 # sokoban file format: characters and their meaning
@@ -16,10 +27,130 @@ DIRMAP = {  # coords are (y,x)
     DIRW: (0, -1)
 }
 
+# move history: one byte per move, a direction code and the push flag
+HIST_DIRS = (DIRN, DIRS, DIRE, DIRW)  # direction of each code
+HIST_CODES = {d: c for c, d in enumerate(HIST_DIRS)}
+HIST_PUSH = 4
+# LURD letter of each history byte
+HIST_LURD = [LURD[HIST_DIRS[b & 3]].upper() if b & HIST_PUSH
+             else LURD[HIST_DIRS[b & 3]] for b in range(8)]
+LURD_DIRS = {c: d for d, c in LURD.items()}
+
+
+class Layout:
+    """ The immutable part of a level, shared by all copies of its state:
+    a rectangular map, goal positions, the starting position,
+    and tables precomputed from them.
+    Walls, goals and boxes are stored as bitmasks over the flattened map,
+    and the player as a single cell index (see board.py). 
+    dead_bits and freeze_squares come from deadlock.py, computed once here. 
+    corridors are the corridor_segments of deadlock.py.
+    surplus is how many more boxes than goals there are: deadlocks only
+    count when more boxes than that are stuck.
+    goal_distances are push distance tables, one per goal (see heuristic.py).
+    start is the snapshot of the starting position, see Level.snapshot.
+    A layout built from packed tables (see pack) unpacks freeze_squares,
+    corridors and goal_distances the first time they are read.
+    """
+
+    def __init__(self, w, h, walls, goals, player_idx, boxes, packed=None):
+        """ packed is a tuple returned by pack(): the tables are computed
+        here when not given.
+        """
+        self.height = h
+        self.width = w
+        self.wall_bits = walls
+        self.goal_bits = goals
+        self.goals = bits_to_cells(goals, w)
+        # cell index offset of each direction
+        self.deltas = {d: dy * w + dx for d, (dy, dx) in DIRMAP.items()}
+        self.base_player_idx = player_idx
+        self.base_box_bits = boxes
+        self.surplus = max(0, popcount(boxes) - popcount(goals))
+        self.zobrist = keys_for(w * h)
+        if packed is not None:
+            (self.dead_bits, self._corners, self._segments, self._distances,
+             self.base_hash, dead) = packed
+            self.start = (player_idx, boxes, self.base_hash, dead)
+            return
+        self.dead_bits = dead_squares(walls, goals, w, h)
+        self.freeze_squares = freeze_squares(walls, w, h)
+        self.corridors = corridor_segments(walls, goals, w, h)
+        self.goal_distances = push_distances(walls, goals, w, h)
+        self.base_hash = (self.zobrist.box_hash(boxes)
+                          ^ self.zobrist.player[player_idx])
+        dead = is_deadlocked(boxes, walls, goals, self.dead_bits,
+                             self.freeze_squares, self.surplus)
+        self.start = (player_idx, boxes, self.base_hash, dead)
+
+    def pack(self):
+        """ the precomputed tables and starting hash, as a tuple of ints and
+        arrays, cheap to pickle and to unpack: the cells of the top left
+        corner of each freeze square, the bitmask of each corridor, and the
+        goal distance tables end to end, in the smallest unsigned type that
+        fits, its largest value standing for UNREACHABLE.
+        """
+        corners = array('I', sorted({lowest(sq) for sqs in self.freeze_squares
+                                     for sq in sqs}))
+        segments = sorted(set(self.corridors) - {0})
+        n = self.width * self.height
+        for code in 'BHI':  # distances are under n
+            far = (1 << 8 * array(code).itemsize) - 1  # for UNREACHABLE
+            if n < far:
+                break
+        distances = array(code, (far if d == UNREACHABLE else d
+                                 for d in chain.from_iterable(
+                                     self.goal_distances)))
+        return (self.dead_bits, corners, segments, distances,
+                self.base_hash, self.start[3])
+
+    @cached_property
+    def freeze_squares(self):
+        w = self.width
+        squares = [[] for _ in range(w * self.height)]
+        for i in self._corners:  # in cell order, like deadlock.py
+            sq = 1 << i | 1 << (i + 1) | 1 << (i + w) | 1 << (i + w + 1)
+            for c in (i, i + 1, i + w, i + w + 1):
+                squares[c].append(sq)
+        return squares
+
+    @cached_property
+    def corridors(self):
+        corridors = [0] * (self.width * self.height)
+        for seg in self._segments:
+            for c in iter_bits(seg):
+                corridors[c] = seg
+        return corridors
+
+    @cached_property
+    def goal_distances(self):
+        n, dist = self.width * self.height, self._distances
+        far = (1 << 8 * dist.itemsize) - 1
+        dist = [UNREACHABLE if d == far else d for d in dist]
+        return [dist[k:k + n] for k in range(0, len(dist), n)]
+
+    def is_dead_push(self, cell, boxes, player):
+        """ true if the box just pushed to cell, by the player now on cell
+        player, deadlocks boxes
+        """
+        stuck = corridor_stuck(cell, player, boxes, self.corridors)
+        if self.surplus:  # any stuck box may be one left over
+            stuck |= stuck_boxes(boxes, self.wall_bits, self.goal_bits,
+                                 self.dead_bits, self.freeze_squares)
+            return popcount(stuck) > self.surplus
+        return bool(stuck or self.dead_bits >> cell & 1) or is_frozen(
+            cell, boxes, self.wall_bits, self.goal_bits, self.freeze_squares)
+
 
 class Level:
-    """ A Level is a 16x16 map, a player starting position, 
-    a list of goal positions, and a list of starting box positions. 
+    """ A Level is a Layout, shared and never modified, and the mutable
+    state of a game on it: player cell index, box bitmask, and hash.
+    Layout attributes are read through the level, eg level.wall_bits.
+    hash is the zobrist hash of the player and boxes, kept up to date by move.
+    deadlocked becomes true as soon as a push makes the level unwinnable.
+    history holds one byte per move since the last reset, see HIST_PUSH.
+    Its first n_moves bytes are the moves done, the others can be redone.
+    tiles, goals, player and boxes remain available as (y,x) views.
     """
 
     def __init__(self, level_num, tiles, goals, player, boxes):
@@ -27,31 +158,133 @@ class Level:
         positions are 2-tuples. 
         goals and boxes are lists of 2-tuples, player a 2-tuple.
         """
+        w = len(tiles[0])
+        self._setup(level_num, Layout(
+            w, len(tiles), cells_to_bits(find_element(TWAL, tiles), w),
+            cells_to_bits(goals, w), to_index(player, w),
+            cells_to_bits(boxes, w)))
+
+    def _setup(self, level_num, layout):
         self.level_num = level_num
-        self.base_tiles = tiles  # use these to reset level
-        self.base_goals = goals
-        self.base_player = player
-        self.base_boxes = boxes
-        self.tiles = None
-        self.goals = None
-        self.player = None
-        self.boxes = None
+        self.layout = layout
+        self.player_idx = None
+        self.box_bits = None
+        self.hash = None
+        self.deadlocked = False
+        self.history = array('B')
+        self.n_moves = 0
+        self._dead_at = None  # n_moves when the level got deadlocked
         self.reset()
 
+    def __getattr__(self, name):
+        """ anything not in the state is read from the layout """
+        if name == 'layout':  # not set yet, eg while unpickling
+            raise AttributeError(name)
+        return getattr(self.layout, name)
+
+    @classmethod
+    def from_bits(cls, level_num, w, h, walls, goals, player_idx, boxes):
+        """ build a Level of width w and height h from bitmasks,
+        eg as stored by level_cache.py.
+        """
+        level = cls.__new__(cls)
+        level._setup(level_num,
+                     Layout(w, h, walls, goals, player_idx, boxes))
+        return level
+
+    def bits(self):
+        """ (w, h, walls, goals, player_idx, boxes) of the starting
+        position, as taken by from_bits after the level number
+        """
+        lay = self.layout
+        return (lay.width, lay.height, lay.wall_bits, lay.goal_bits,
+                lay.base_player_idx, lay.base_box_bits)
+
+    def record(self):
+        """ compact tuple of the starting position and packed tables,
+        cheap to pickle, see Layout.pack. The level number is left out.
+        """
+        return self.bits() + (self.layout.pack(),)
+
+    @classmethod
+    def from_record(cls, level_num, rec):
+        """ build a Level from a tuple returned by record() """
+        level = cls.__new__(cls)
+        level._setup(level_num, Layout(*rec))
+        return level
+
+    def clone(self):
+        """ new Level in the current state, sharing the layout.
+        The history is not copied.
+        """
+        level = Level.__new__(Level)
+        level.level_num = self.level_num
+        level.layout = self.layout
+        level.restore(self.snapshot())
+        return level
+
+    def snapshot(self):
+        """ the current state, as an immutable tuple
+        (player_idx, box_bits, hash, deadlocked). O(1).
+        """
+        return self.player_idx, self.box_bits, self.hash, self.deadlocked
+
+    def restore(self, snap):
+        """ go back to a state returned by snapshot(), in O(1).
+        The history starts over from there.
+        """
+        self.player_idx, self.box_bits, self.hash, self.deadlocked = snap
+        self._dead_at = 0 if self.deadlocked else None
+        self.history = array('B')
+        self.n_moves = 0
+
     def __repr__(self):
         return pretty_level_print(self.level_num, self.tiles)
 
+    @property
+    def player(self):
+        """ player position as (y,x) """
+        return to_pos(self.player_idx, self.width)
+
+    @property
+    def boxes(self):
+        """ box positions as a list of (y,x), in row-major order """
+        return bits_to_cells(self.box_bits, self.width)
+
+    @property
+    def tiles(self):
+        """ list of lists of characters, built from the bitmasks """
+        w, walls = self.width, self.wall_bits
+        goals, boxes = self.goal_bits, self.box_bits
+        tiles = []
+        for y in range(self.height):
+            row = []
+            for i in range(y * w, (y + 1) * w):
+                bit = 1 << i
+                if walls & bit:
+                    row.append(TWAL)
+                elif i == self.player_idx:
+                    row.append(TPGL if goals & bit else TPLR)
+                elif boxes & bit:
+                    row.append(TBGL if goals & bit else TBOX)
+                else:
+                    row.append(TGOL if goals & bit else TFLR)
+            tiles.append(row)
+        return tiles
+
+    def digest(self):
+        """ hex string identifying the starting position of the level,
+        whatever its number, its file, or the padding around it. 
+        """
+        return digest_bits(*self.bits())
+
     def is_complete(self):
         """ true if each goal has a box, false otherwise """
-        free = sum([0 if goal in self.boxes else 1 for goal in self.goals])
-        return free == 0
+        return self.goal_bits & ~self.box_bits == 0
 
     def reset(self):
-        """ prepare mutable game state """
-        self.tiles = deepcopy(self.base_tiles)
-        self.goals = deepcopy(self.base_goals)
-        self.player = deepcopy(self.base_player)
-        self.boxes = deepcopy(self.base_boxes)
+        """ back to the starting position """
+        self.restore(self.layout.start)
         log = logging.getLogger('game')
         log.debug('reset level %d ' % self.level_num)
 
@@ -59,33 +292,114 @@ class Level:
         """ execute move in direction d if possible. 
         return true if player moved, false otherwise. 
         does not check for victory condition.
+        The move is added to the history, and the moves undone are lost.
         """
-        tiles = self.tiles
-        dy, dx = DIRMAP[d]
-        y, x = self.player
-        src = tiles[y][x]
-        d1y, d1x = y + dy, x + dx
-        dest1 = tiles[d1y][d1x]  # walls around. Should be in bounds
-
-        if tiles[d1y][d1x] == TWAL:  # wall: cant move 
+        pushed = self._step(d)
+        if pushed is None:
             return False
-        elif (d1y, d1x) in self.boxes:  # box: check if can push 
-            d2y, d2x = y + 2 * dy, x + 2 * dx
-            dest2 = tiles[d2y][d2x]  # beyond the box, should be in bounds
-            if (d2y, d2x) in self.boxes or dest2 == TWAL:  # other box or wall
-                return False
-            else:  # can push box: move the box 
-                tiles[d2y][d2x] = TBGL if dest2 == TGOL else TBOX
-                tiles[d1y][d1x] = TGOL if dest1 == TBGL else TFLR
-                i = self.boxes.index((d1y, d1x))
-                self.boxes[i] = (d2y, d2x)
+        del self.history[self.n_moves:]
+        self.history.append(HIST_CODES[d] | (HIST_PUSH if pushed else 0))
+        self.n_moves += 1
+        return True
+
+    def _step(self, d):
+        """ move in direction d. return None if blocked, otherwise whether
+        a box was pushed.
+        """
+        lay = self.layout
+        delta = lay.deltas[d]
+        d1 = self.player_idx + delta  # walls around. Should be in bounds
+        bit1 = 1 << d1
+        if lay.wall_bits & bit1:  # wall: cant move 
+            return None
+        keys = lay.zobrist
+        pushed = False
+        if self.box_bits & bit1:  # box: check if can push 
+            d2 = d1 + delta  # beyond the box, should be in bounds
+            bit2 = 1 << d2
+            if (lay.wall_bits | self.box_bits) & bit2:  # other box or wall
+                return None
+            self.box_bits ^= bit1 | bit2  # can push box: move the box 
+            self.hash ^= keys.box[d1] ^ keys.box[d2]
+            pushed = True
+            if not self.deadlocked and lay.is_dead_push(
+                    d2, self.box_bits, d1):
+                self.deadlocked = True
+                self._dead_at = self.n_moves + 1
 
         # whether pushing box or not, move player 
-        tiles[y][x] = TGOL if src == TPGL else TFLR
-        tiles[d1y][d1x] = TPGL if dest1 in (TGOL, TBGL) else TPLR
-        self.player = d1y, d1x
+        self.hash ^= keys.player[self.player_idx] ^ keys.player[d1]
+        self.player_idx = d1
+        return pushed
+
+    def undo(self):
+        """ take back the last move. return false if there is none. """
+        if not self.n_moves:
+            return False
+        self.n_moves -= 1
+        b = self.history[self.n_moves]
+        lay = self.layout
+        delta = lay.deltas[HIST_DIRS[b & 3]]
+        p0, p1 = self.player_idx - delta, self.player_idx
+        keys = lay.zobrist
+        if b & HIST_PUSH:  # pull the box back where the player was
+            p2 = p1 + delta
+            self.box_bits ^= 1 << p1 | 1 << p2
+            self.hash ^= keys.box[p1] ^ keys.box[p2]
+        self.hash ^= keys.player[p1] ^ keys.player[p0]
+        self.player_idx = p0
+        if self._dead_at is not None and self.n_moves < self._dead_at:
+            self.deadlocked = False
+            self._dead_at = None
         return True
 
+    def redo(self):
+        """ do again the last move undone. return false if there is none. """
+        if self.n_moves == len(self.history):
+            return False
+        self._step(HIST_DIRS[self.history[self.n_moves] & 3])
+        self.n_moves += 1
+        return True
+
+    def lurd(self):
+        """ moves done since the last reset, in LURD notation:
+        lowercase letters for steps, uppercase letters for pushes.
+        """
+        return ''.join([HIST_LURD[b] for b in self.history[:self.n_moves]])
+
+    def play_lurd(self, moves):
+        """ reset the level, then play moves, a string in LURD notation.
+        Letter case is not checked: the level knows when a box is pushed.
+        return true if every move could be played. Stops at the first
+        unknown letter or blocked move.
+        """
+        self.reset()
+        for c in moves:
+            d = LURD_DIRS.get(c.lower())
+            if d is None or not self.move(d):
+                return False
+        return True
+
+
+def digest_bits(w, h, walls, goals, player_idx, boxes):
+    """ Level.digest of a starting position given as bitmasks, eg read
+    from a level cache without building the Level.
+    """
+    floor = ~walls & ((1 << w * h) - 1)
+    cells = [to_pos(i, w) for i in iter_bits(floor)]
+    y0 = min(y for y, _ in cells)
+    x0 = min(x for _, x in cells)
+    txt = []
+    for i, (y, x) in zip(iter_bits(floor), cells):
+        if i == player_idx:
+            c = TPGL if goals >> i & 1 else TPLR
+        elif boxes >> i & 1:
+            c = TBGL if goals >> i & 1 else TBOX
+        else:
+            c = TGOL if goals >> i & 1 else TFLR
+        txt.append('%d,%d%s' % (y - y0, x - x0, c))
+    return hashlib.sha1(';'.join(txt).encode()).hexdigest()
+
 
 def pretty_level_print(level_num, tiles):
     txt = 'Level ' + str(level_num) + '\n'
@@ -108,30 +422,32 @@ def find_element(e, l):
 
 
 def flood_fill(tiles, pos, from_values, to_value):
-    """ recursive flood fill https://en.wikipedia.org/wiki/Flood_fill
+    """ flood fill https://en.wikipedia.org/wiki/Flood_fill
     tiles must be a rectangular list of lists, tiles[j][i] is row j column i. 
     pos is a position in tiles to start flooding from.
     from_values must be a list or set, not a single value.
+    Iterative, with an explicit stack: no recursion limit on big maps.
     """
-    y, x = pos
-    if y < 0 or y >= len(tiles) or x < 0 or x >= len(tiles[0]):
-        return  # out of bounds
-    if tiles[y][x] == to_value or tiles[y][x] not in from_values:
-        return  # already filled
-    tiles[y][x] = to_value
-    flood_fill(tiles, (y, x + 1), from_values, to_value)
-    flood_fill(tiles, (y, x - 1), from_values, to_value)
-    flood_fill(tiles, (y - 1, x), from_values, to_value)
-    flood_fill(tiles, (y + 1, x), from_values, to_value)
-
-
-def build_level_from_tiles(tiles, maxs=16, level_num=0):
+    h, w = len(tiles), len(tiles[0])
+    stack = [pos]
+    while stack:
+        y, x = stack.pop()
+        if y < 0 or y >= h or x < 0 or x >= w:
+            continue  # out of bounds
+        if tiles[y][x] == to_value or tiles[y][x] not in from_values:
+            continue  # already filled
+        tiles[y][x] = to_value
+        stack += [(y + 1, x), (y - 1, x), (y, x - 1), (y, x + 1)]
+
+
+def build_level_from_tiles(tiles, maxs=None, level_num=0):
     """ tiles is a list of lists of characters. 
-    maxs is max size of level output. 
-    return a square Level if tiles are well-formed, None otherwise.
+    maxs is the max width and height of a level, None for any size.
+    return a Level if tiles are well-formed, None otherwise.
+    The Level is cropped to the cells the player can reach, plus one
+    ring of walls around them: no padding, and any rectangular shape.
     Well-formed tiles means: 
-    - widest row and tallest column are less than max size, 
-    - enough room to support walls all around the periphery,
+    - widest row and tallest column are at most max size, 
     - the number of boxes is at least the number of goals,
     - must have 1+ box, 1+ empty goal, and exactly 1 player,
     - each tile must be in the supported tileset '@.#*$ '
@@ -140,7 +456,7 @@ def build_level_from_tiles(tiles, maxs=16, level_num=0):
 
     w = max(map(lambda x: len(x), tiles))
     h = len(tiles)
-    if w > maxs or h > maxs:  # too wide or too tall
+    if maxs and (w > maxs or h > maxs):  # too wide or too tall
         log.warning('Level %d too wide or too tall: (%d,%d), expected max %s'
                     % (level_num, w, h, maxs))
         log.debug(pretty_level_print(level_num, tiles))
@@ -156,14 +472,6 @@ def build_level_from_tiles(tiles, maxs=16, level_num=0):
 
     # add walls at the end of short rows
     tiles = [line + [TWAL] * (w - len(line)) for line in tiles]
-    # widen map: add walls evenly on left and right sides to reach max width 
-    for i, line in enumerate(tiles):
-        left_hole = (maxs - len(line)) // 2
-        right_hole = maxs - len(line) - left_hole
-        tiles[i] = [TWAL] * left_hole + tiles[i] + [TWAL] * right_hole
-    # add rows of walls above and below, if necessary
-    tiles = [[TWAL] * maxs] * ((maxs - h) // 2) + tiles
-    tiles = tiles + [[TWAL] * maxs] * (maxs - len(tiles))  # remaining missing
 
     # find player position, and check if missing or too many
     start = find_element('@', tiles) + find_element('+', tiles)
@@ -171,7 +479,33 @@ def build_level_from_tiles(tiles, maxs=16, level_num=0):
         log.warning('Level has 0 or >1 player starting positions: %s' % str(start))
         log.debug(pretty_level_print(level_num, tiles))
         return None
-    start = start[0]
+
+    # keep the cells the player can reach. The player walks on a board
+    # framed by one more wall all around, so that bit shifts never wrap.
+    fw = w + 2
+    free = 0
+    for j, row in enumerate(tiles):
+        for i, tile in enumerate(row):
+            if tile != TWAL:
+                free |= 1 << ((j + 1) * fw + i + 1)
+    (y, x), = start
+    reach = reachable((y + 1) * fw + x + 1, free, fw)
+    # crop to the reachable cells and a ring of walls: y0, x0 are the top
+    # left corner in tiles, which may be just outside of them
+    cells = [divmod(i, fw) for i in iter_bits(reach)]
+    y0 = cells[0][0] - 2
+    y1 = cells[-1][0]
+    x0 = min(x for _, x in cells) - 2
+    x1 = max(x for _, x in cells)
+    if maxs and (x1 - x0 >= maxs or y1 - y0 >= maxs):
+        log.warning('Level %d has no room for walls all around: (%d,%d),'
+                    ' expected max %s'
+                    % (level_num, x1 - x0 + 1, y1 - y0 + 1, maxs))
+        log.debug(pretty_level_print(level_num, tiles))
+        return None
+    tiles = [[tiles[j][i] if reach >> ((j + 1) * fw + i + 1) & 1 else TWAL
+              for i in range(x0, x1 + 1)] for j in range(y0, y1 + 1)]
+    start = (y - y0, x - x0)
 
     # find goal positions, and check at least one of them has no box on it
     goals = find_element('.', tiles) + find_element('+', tiles)
@@ -192,51 +526,171 @@ def build_level_from_tiles(tiles, maxs=16, level_num=0):
         log.debug(pretty_level_print(level_num, tiles))
         return None
 
-    # replace unreachable tiles by walls via flood filling algo
-    reach = [[0 if tile == TWAL else 1 for tile in row] for row in tiles]
-    flood_fill(reach, start, [1], 2)  # fill reachable 1s to 2s, 0s stay walls
-    tiles = [
-        [tile if reach[j][i] == 2 else TWAL for i, tile in enumerate(row)]
-        for j, row in enumerate(tiles)
-    ]
+    return Level(level_num, tiles, goals, start, boxes)
 
-    # check that there are walls all around the periphery
-    n_walls = sum([1 if e == TWAL else 0 for e in tiles[0]])
-    n_walls += sum([1 if row[0] == TWAL else 0 for row in tiles[1:-1]])
-    n_walls += sum([1 if row[-1] == TWAL else 0 for row in tiles[1:-1]])
-    n_walls += sum([1 if e == TWAL else 0 for e in tiles[-1]])
-    if n_walls != 4 * (maxs - 1):
-        log.warning('Level has %d peripheral walls, need %d'
-              % (n_walls, 4 * (maxs - 1)))
-        log.debug(pretty_level_print(level_num, tiles))
-        return None
 
-    return Level(level_num, tiles, goals, start, boxes)
+class LevelEntry:
+    """ Where a level is in its level-set file, the comment lines found
+    between the previous level and this one, and the notes: the comment
+    lines right after the level, before any empty line.
+    """
+
+    def __init__(self, level_num, offset, length, comments, notes=()):
+        self.level_num = level_num
+        self.offset = offset  # in bytes, from the start of the file
+        self.length = length  # in bytes
+        self.comments = comments
+        self.notes = list(notes)
+
+    @property
+    def title(self):
+        """ last note after the level, eg '2' for '; 2', or else the last
+        comment before it, eg 'Level 3'. Sets that number their levels
+        after them often start with a header, which is not a title.
+        """
+        lines = self.notes or self.comments
+        if not lines:
+            return ''
+        return lines[-1].lstrip(';').strip()
+
+
+def iter_level_blocks(f):
+    """ yield (offset, length, comments, tiles, notes) for each block of
+    tile lines in f, a file opened in binary mode. offset and length are
+    in bytes. comments are the lines between the previous block and this
+    one, notes the comment lines right after this one, see LevelEntry.
+    Reads one line at a time.
+    """
+    offset = start = 0
+    tiles = []
+    comments = []
+    block = None  # block waiting for the end of its notes
+    for raw in chain(f, [b'\n']):  # extra line break for last level
+        line = raw.decode('utf-8', 'replace')
+        if line and line[0] in TILESET:
+            if block:
+                yield block
+                block = None
+            if not tiles:
+                start = offset
+            tiles.append(list(line.rstrip('\r\n')))
+        else:  # empty or comment line
+            if tiles:  # we have lines to build from
+                block = (start, offset - start, comments, tiles, [])
+                tiles = []
+                comments = []
+            if not line.strip():  # an empty line ends the notes
+                if block:
+                    yield block
+                    block = None
+            elif block:
+                block[4].append(line.strip())
+            else:
+                comments.append(line.strip())
+        offset += len(raw)
+    if block:  # last line was a note
+        yield block
+
+
+def iter_level_set(filepath, maxs=None):
+    """ yield (level, LevelEntry) for each well-formed level of filepath,
+    parsing one level at a time. Malformed levels are logged and skipped.
+    """
+    with open(filepath, 'rb') as f:
+        level_num = 0
+        for offset, length, comments, tiles, notes in iter_level_blocks(f):
+            level = build_level_from_tiles(tiles, maxs, level_num)
+            if level:  # well-formed level
+                yield level, LevelEntry(level_num, offset, length, comments,
+                                        notes)
+                level_num += 1
 
 
-def load_level_set(filepath, maxs=16):
-    """ return list of levels, or None if cant load the file """
+# level blocks sent to a worker at once, by the parallel loader
+PARALLEL_CHUNK = 32
+# smaller level-set files are loaded serially: starting the worker
+# processes costs more than building their levels (the bundled sets take
+# a few tens of ms)
+PARALLEL_MIN_BYTES = 256 * 1024
+
+
+def _quiet_worker():
+    """ workers only validate levels: the parent logs, in file order """
+    logging.getLogger('game').disabled = True
+
+
+def _build_records(blocks, maxs):
+    """ worker: Level.record() of each list of tiles, None if malformed """
+    records = []
+    for tiles in blocks:
+        level = build_level_from_tiles(tiles, maxs)
+        records.append(level.record() if level else None)
+    return records
+
+
+def iter_level_set_parallel(filepath, maxs=None, workers=None):
+    """ like iter_level_set, building levels in a pool of worker processes.
+    Levels come out in file order, with the same numbers and the same log
+    messages: malformed levels are built again in this process to log why.
+    At most 2 chunks of blocks per worker are read ahead of the output.
+    """
+    workers = workers or os.cpu_count()
+    pending = deque()  # (blocks, future of their records), in file order
+    level_num = 0
+    with open(filepath, 'rb') as f, ProcessPoolExecutor(
+            workers, initializer=_quiet_worker) as pool:
+        blocks = iter_level_blocks(f)
+        while True:
+            chunk = list(islice(blocks, PARALLEL_CHUNK))
+            if chunk:
+                tiles = [b[3] for b in chunk]
+                pending.append((chunk, pool.submit(_build_records, tiles,
+                                                   maxs)))
+            if not pending:
+                break
+            if chunk and len(pending) < 2 * workers:
+                continue  # read ahead
+            done, future = pending.popleft()
+            for (offset, length, comments, tiles, notes), rec in zip(
+                    done, future.result()):
+                if rec is None:
+                    build_level_from_tiles(tiles, maxs, level_num)  # logs
+                    continue
+                yield (Level.from_record(level_num, rec),
+                       LevelEntry(level_num, offset, length, comments,
+                                  notes))
+                level_num += 1
+
+
+def index_level_set(filepath, maxs=None):
+    """ return the list of LevelEntry of the well-formed levels of filepath """
+    return [entry for _, entry in iter_level_set(filepath, maxs)]
+
+
+def load_level_at(filepath, entry, maxs=None):
+    """ build the level of entry, reading only its bytes from filepath """
+    with open(filepath, 'rb') as f:
+        f.seek(entry.offset)
+        txt = f.read(entry.length).decode('utf-8', 'replace')
+    tiles = [list(line.rstrip('\r')) for line in txt.split('\n') if line]
+    return build_level_from_tiles(tiles, maxs, entry.level_num)
+
+
+def load_level_set(filepath, maxs=None, workers=None):
+    """ return list of levels, or None if cant load the file.
+    With workers > 1, levels are built by that many processes, unless the
+    file is smaller than PARALLEL_MIN_BYTES.
+    """
     log = logging.getLogger('game')
     if not os.path.isfile(filepath):
         log.error('could not find level-set file %s' % filepath)
         return None
-
-    with open(filepath, 'r') as f:
-        levels = []
-        level_tiles = []
-        level_num = 0
-        for line in list(f) + ['\n']:  # extra line break for last level
-            if line and line[0] in TILESET:
-                level_tiles.append(list(line.rstrip('\r\n')))
-            else:  # empty or comment line
-                if level_tiles:  # we have lines to build from
-                    level = build_level_from_tiles(level_tiles, maxs, level_num)
-                    if level:  # well-formed level
-                        levels.append(level)
-                        level_num += 1
-                    level_tiles = []
-
-    return levels
+    if (workers and workers > 1
+            and os.path.getsize(filepath) >= PARALLEL_MIN_BYTES):
+        levels = iter_level_set_parallel(filepath, maxs, workers)
+    else:
+        levels = iter_level_set(filepath, maxs)
+    return [level for level, _ in levels]
 
 
 ################# TESTS ##################
@@ -280,17 +734,23 @@ def test_build_level_from_tiles():
     tiles = list(map(lambda x: list(x), ['#####', '#+$ #', '#####']))
     level = build_level_from_tiles(tiles, 16)
     assert level is not None
+    assert (level.width, level.height) == (5, 3)  # no padding
     assert len(level.goals) == 1
-    assert level.goals[0] == (7, 6)
-    assert level.player == (7, 6)
+    assert level.goals[0] == (1, 1)
+    assert level.player == (1, 1)
     assert len(level.boxes) == 1
-    assert level.boxes[0] == (7, 7)
+    assert level.boxes[0] == (1, 2)
+    # floor on the edge: a ring of walls is added around it
+    tiles = [list(r) for r in ['#####', '#@$. ', '#####']]
+    level = build_level_from_tiles(tiles)
+    assert (level.width, level.height) == (6, 3)
+    assert level.tiles[1] == list('#@$. #')
+    assert build_level_from_tiles(tiles, 5) is None  # no room for the ring
 
 
 def test_build_level_from_tiles2():
-    """ In the level below, test that padding does not shift row 2 to the right.
-    padding should add 4 walls top right and 2 walls bottom right.
-    padding should also add 4 rows of walls at the top, 5 bot, 5 left, 5 right.
+    """ In the level below, test that short rows do not shift to the right.
+    walls should be added: 2 top right and 2 bottom right.
     """
     level_str = (
         "####\n"
@@ -304,10 +764,11 @@ def test_build_level_from_tiles2():
     tiles = list(map(lambda x: list(x), level_str.split(sep='\n')))
     level = build_level_from_tiles(tiles, 16)
     assert level
-    assert level.tiles[4][9] == TWAL  # added wall just right of row 1 above
-    assert level.tiles[10][10] == TWAL  # added wall 2 times right of row 7
-    assert level.tiles[5][6] == TFLR  # row 2's empty floor
-    assert level.tiles[5][7] == TGOL  # row 2's goal
+    assert (level.width, level.height) == (6, 7)
+    assert level.tiles[0][4] == TWAL  # added wall just right of row 1 above
+    assert level.tiles[6][5] == TWAL  # added wall 2 times right of row 7
+    assert level.tiles[1][1] == TFLR  # row 2's empty floor
+    assert level.tiles[1][2] == TGOL  # row 2's goal
 
 
 def test_build_level_from_tiles3():
@@ -324,10 +785,10 @@ def test_build_level_from_tiles3():
     tiles = list(map(lambda x: list(x), level_str.split(sep='\n')))
     level = build_level_from_tiles(tiles, 16)
     assert level
-    assert level.tiles[5][5] == TGOL  # short lines dont shift right
-    assert level.tiles[6][7] == TWAL  # test that middle hole gets filled
-    assert level.tiles[9][4] == TWAL  # before-last row's first hole gets filled 
-    assert level.tiles[10][4] == TWAL  # last row's first 2 holes get filled 
+    assert level.tiles[1][1] == TGOL  # short lines dont shift right
+    assert level.tiles[2][3] == TWAL  # test that middle hole gets filled
+    assert level.tiles[5][0] == TWAL  # before-last row's first hole gets filled 
+    assert level.tiles[6][0] == TWAL  # last row's first 2 holes get filled 
 
 
 def test_build_level_from_tiles4():
@@ -344,6 +805,23 @@ def test_build_level_from_tiles4():
     assert level
 
 
+def test_build_level_from_tiles_large():
+    """ a big open room: deeper than the recursion limit to flood """
+    n = 60
+    rows = ['#' * n] + ['#' + ' ' * (n - 2) + '#'] * (n - 2) + ['#' * n]
+    tiles = [list(r) for r in rows]
+    tiles[1][1], tiles[2][2], tiles[3][3] = TPLR, TBOX, TGOL
+    level = build_level_from_tiles(tiles)
+    assert level is not None
+    assert (level.width, level.height) == (n, n)
+    assert level.player == (1, 1)
+    assert level.tiles[2][3] == TFLR and level.tiles[0][0] == TWAL
+    assert build_level_from_tiles(tiles, 16) is None  # too big
+    flood = [[1] * n for _ in range(n)]
+    flood_fill(flood, (0, 0), [1], 2)
+    assert all(c == 2 for row in flood for c in row)
+
+
 def test_load_level_set():
     """ create a levelset file, load set, test set, delete file """
     filename = 'levelset.txt.test'
@@ -354,11 +832,10 @@ def test_load_level_set():
         f.write('level 1\n' + level1 + '\r\n')
         f.write('level 2\n' + level2)
     # load and test set
-    maxs = 16
-    levels = load_level_set(filename, maxs)
+    levels = load_level_set(filename)
     assert len(levels) == 2  # detected 2 well-formed levels
-    assert levels[0] and len(levels[0].tiles) == maxs
-    assert levels[1] and len(levels[1].tiles) == maxs
+    assert levels[0] and len(levels[0].tiles) == 3
+    assert levels[1] and len(levels[1].tiles) == 4
     # delete file
     try:
         os.remove(filename)
@@ -390,6 +867,228 @@ def test_moves():
     level.move(DIRW)
     assert level.goals == level.boxes
     assert level.player == (3, 4)
+    assert level.is_complete()
+    keys = level.zobrist
+    assert level.hash == keys.box_hash(level.box_bits) ^ keys.player[3 * 8 + 4]
+    level.reset()
+    assert level.hash == level.base_hash
+
+
+def test_tiles_view():
+    """ tiles rebuilt from the bitmasks match the tiles the level came from """
+    tiles = [
+        "######",
+        "#@$.*#",
+        "#.  $#",
+        "######"
+    ]
+    tiles = list(map(lambda r: list(r), tiles))
+    goals, boxes = [(1, 3), (1, 4), (2, 1)], [(1, 2), (1, 4), (2, 4)]
+    level = Level(0, tiles, goals, (1, 1), boxes)
+    assert level.tiles[1] == list('#@$.*#')
+    assert level.tiles[2] == list('#.  $#')
+    level.move(DIRE)
+    assert level.tiles[1] == list('# @**#')
+    assert not level.is_complete()
+
+
+def test_deadlocked():
+    """ push a box past its goal, into a dead square """
+    tiles = [
+        "#######",
+        "#@$ . #",
+        "#     #",
+        "#######"
+    ]
+    tiles = list(map(lambda r: list(r), tiles))
+    level = Level(0, tiles, [(1, 4)], (1, 1), [(1, 2)])
+    assert level.dead_bits >> (2 * 7 + 2) & 1  # along the bottom wall
+    assert not level.deadlocked
+    level.move(DIRE)
+    level.move(DIRE)
+    assert level.is_complete() and not level.deadlocked
+    level.move(DIRE)
+    assert level.deadlocked
+    level.reset()
+    assert not level.deadlocked
+    # two boxes in a corridor without goals, the player outside
+    tiles = [
+        "#########",
+        "#   ##  #",
+        "#@$  $ .#",
+        "#   ##  #",
+        "#      .#",
+        "#########"
+    ]
+    level = build_level_from_tiles([list(r) for r in tiles])
+    assert level.corridors[22] == level.corridors[23] == 3 << 22
+    level.move(DIRE)
+    assert not level.deadlocked
+    level.move(DIRE)  # into the corridor, towards the other box
+    assert level.deadlocked
+
+
+def test_history():
+    """ undo, redo, and LURD export and import """
+    tiles = [list(r) for r in ["#######", "#@$ . #", "#     #", "#######"]]
+    level = Level(0, tiles, [(1, 4)], (1, 1), [(1, 2)])
+    for d in (DIRE, DIRE, DIRE, DIRS):
+        level.move(d)
+    assert level.deadlocked  # box pushed past its goal
+    assert level.lurd() == 'RRRd'
+    assert level.history.itemsize == 1 and len(level.history) == 4
+    after = (level.player_idx, level.box_bits, level.hash)
+    assert level.undo() and level.undo()
+    assert not level.deadlocked and level.is_complete()
+    assert level.undo() and level.undo() and not level.undo()
+    assert (level.player_idx, level.box_bits) == (8, 1 << 9)
+    assert level.hash == level.base_hash
+    while level.redo():
+        pass
+    assert (level.player_idx, level.box_bits, level.hash) == after
+    assert level.deadlocked
+    # a new move after undoing drops the moves undone
+    level.undo()
+    level.undo()
+    level.move(DIRS)
+    assert level.lurd() == 'RRd' and not level.redo()
+    # import
+    assert level.play_lurd('RRdl')
+    assert level.lurd() == 'RRdl' and level.is_complete()
+    assert not level.play_lurd('RRRR')  # blocked by the wall
+    assert level.lurd() == 'RRR'
+    assert not level.play_lurd('x')
+    level.reset()
+    assert level.n_moves == 0 and not level.history
+
+
+def test_snapshot():
+    """ restore a snapshot, and clone a level without copying its layout """
+    tiles = [list(r) for r in ["#######", "#@$ . #", "#     #", "#######"]]
+    level = Level(0, tiles, [(1, 4)], (1, 1), [(1, 2)])
+    start = level.snapshot()
+    assert start == level.layout.start
+    level.move(DIRE)
+    snap = level.snapshot()
+    level.move(DIRE)
+    level.move(DIRE)
+    assert level.deadlocked
+    level.restore(snap)
+    assert not level.deadlocked and level.box_bits == 1 << 10
+    assert level.n_moves == 0  # history starts over
+    other = level.clone()
+    assert other.layout is level.layout and other.snapshot() == snap
+    other.move(DIRE)
+    assert level.snapshot() == snap  # states are independent
+    level.reset()
+    assert level.snapshot() == start
+
+
+def test_digest():
+    """ same level with different walls and number has the same digest """
+    rows = ['#####', '#@$.#', '#####']
+    level = build_level_from_tiles([list(r) for r in rows], 8, 0)
+    rows2 = ['  #####', '#######', '##@$.##', '  #####']
+    level2 = build_level_from_tiles([list(r) for r in rows2], 16, 3)
+    assert level.digest() == level2.digest()
+    level2.move(DIRE)
+    assert level.digest() == level2.digest()  # digest of the starting state
+    rows = ['#####', '#@ $.#', '######']
+    level3 = build_level_from_tiles([list(r) for r in rows], 8, 0)
+    assert level3.digest() != level.digest()
+
+
+def test_iter_level_set():
+    """ offsets, titles, and reading a single level back """
+    filename = 'levelset.txt.test'
+    with open(filename, 'wb') as f:
+        f.write(b'My set\nLevel 1\n#####\n#@$.#\n#####\n\n')
+        f.write(b'#bad#\n\n')  # no player: skipped
+        f.write(b'; 3\n#####\r\n#+ $#\r\n#$.*#\r\n#####\r\n; 3 after\r\n')
+    entries = index_level_set(filename, 16)
+    assert [e.title for e in entries] == ['Level 1', '3 after']
+    assert entries[0].comments == ['My set', 'Level 1']
+    assert entries[1].comments == ['; 3'] and entries[1].notes == ['; 3 after']
+    assert entries[0].offset == len(b'My set\nLevel 1\n')
+    assert entries[0].length == len(b'#####\n#@$.#\n#####\n')
+    levels = load_level_set(filename, 16)
+    for level, entry in zip(levels, entries):
+        again = load_level_at(filename, entry, 16)
+        assert again.tiles == level.tiles
+        assert again.level_num == level.level_num == entry.level_num
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def test_level_titles():
+    """ sets that number their levels after them, after a header """
+    filename = 'levelset.txt.test'
+    with open(filename, 'wb') as f:
+        f.write(b'My set\nAuthor: me\n\n\n#####\n#@$.#\n#####\n; 2\n\n')
+        f.write(b'######\n#@$ .#\n######\n; 130')  # no final line break
+    entries = index_level_set(filename)
+    assert [e.title for e in entries] == ['2', '130']
+    assert entries[0].comments == ['My set', 'Author: me']
+    parallel = iter_level_set_parallel(filename, workers=1)
+    assert [e.title for _, e in parallel] == ['2', '130']
+    entries = index_level_set('../assets/maps_after_all.txt')
+    assert len(entries) == 125
+    assert entries[0].title == '2' and entries[-1].title == '130'
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def test_record():
+    """ a level built from its record has the same tables """
+    levels = [lv for lv, _ in islice(
+        iter_level_set('../assets/levels_microban.txt'), 40)]
+    assert any(any(lv.corridors) for lv in levels)
+    for lv in levels:
+        lv2 = Level.from_record(lv.level_num, lv.record())
+        assert lv2.start == lv.start and lv2.dead_bits == lv.dead_bits
+        assert lv2.freeze_squares == lv.freeze_squares
+        assert lv2.corridors == lv.corridors
+        assert lv2.goal_distances == lv.goal_distances
+        assert lv2.record() == lv.record()
+
+
+def test_load_level_set_parallel():
+    """ same levels, entries and warnings as the serial loader """
+    filename = 'levelset.txt.test'
+    good = b'#####\n#@$.#\n#####\n\n'
+    with open(filename, 'wb') as f:
+        for i in range(PARALLEL_CHUNK * 3):
+            f.write(b'#x#\n\n' if i % 7 == 3 else good)  # some bad ones
+
+    class Collect(logging.Handler):
+        def emit(self, record):
+            messages.append(record.getMessage())
+
+    log = logging.getLogger('game')
+    handler = Collect(logging.WARNING)
+    log.addHandler(handler)
+    messages = []
+    serial = list(iter_level_set(filename, 16))
+    serial_messages, messages = messages, []
+    parallel = list(iter_level_set_parallel(filename, 16, workers=2))
+    log.removeHandler(handler)
+    assert messages == serial_messages and len(messages) > 2
+    assert len(parallel) == len(serial)
+    for (lv1, e1), (lv2, e2) in zip(serial, parallel):
+        assert lv1.level_num == lv2.level_num == e2.level_num
+        assert (e1.offset, e1.length) == (e2.offset, e2.length)
+        assert e1.title == e2.title
+        assert lv1.tiles == lv2.tiles and lv1.hash == lv2.hash
+        assert lv1.goal_distances == lv2.goal_distances
+    assert len(load_level_set(filename, 16, workers=2)) == len(serial)
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
 
 
 if __name__ == "__main__":
@@ -400,7 +1099,17 @@ if __name__ == "__main__":
     test_build_level_from_tiles2()
     test_build_level_from_tiles3()
     test_build_level_from_tiles4()
+    test_build_level_from_tiles_large()
     test_load_level_set()
+    test_iter_level_set()
+    test_level_titles()
+    test_record()
+    test_load_level_set_parallel()
 
     test_moves()
+    test_tiles_view()
+    test_deadlocked()
+    test_history()
+    test_snapshot()
+    test_digest()
     # levels = load_level_set('../assets/levels_test.txt', 8)
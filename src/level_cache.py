@@ -0,0 +1,201 @@
+""" Compiled level sets, read lazily through mmap.
+The first load of a level-set text file streams through it, validating
+each level, and writes <level file>.cache next to it: a header, then one
+record per level holding its size, player cell, and wall, goal and box
+bitmasks sized to the level, then the table of record offsets.
+Later loads only read the header; a level is turned into a Level
+the first time it is accessed. The cache is rebuilt when the text file's
+size or modification time, or the maximum level size, change.
+"""
+import logging
+import mmap
+import os
+import struct
+from level import Level, iter_level_set, load_level_set
+
+
+MAGIC = b'SOKC'
+VERSION = 2
+# magic, version, source size, source mtime in ns, maxs (0 for any size),
+# level count, offset of the table of record offsets
+HEADER = struct.Struct('<4sHQQHIQ')
+# level number, width, height, player cell, then 3 bitmasks
+RECORD_HEAD = struct.Struct('<IHHI')
+OFFSET = struct.Struct('<Q')
+
+
+def _nbytes(w, h):
+    """ bytes per bitmask of a w x h level """
+    return (w * h + 7) // 8
+
+
+def cache_path(filepath):
+    return filepath + '.cache'
+
+
+def _source_stamp(filepath):
+    st = os.stat(filepath)
+    return st.st_size, st.st_mtime_ns
+
+
+def compile_level_set(filepath, maxs=None):
+    """ parse filepath one level at a time and write its cache.
+    return the number of levels, or None if the cache could not be written.
+    """
+    log = logging.getLogger('game')
+    size, mtime = _source_stamp(filepath)
+    tmp = cache_path(filepath) + '.tmp'
+    offsets = []
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, size, mtime, maxs or 0, 0, 0))
+            for lv, _ in iter_level_set(filepath, maxs):
+                offsets.append(f.tell())
+                f.write(RECORD_HEAD.pack(lv.level_num, lv.width, lv.height,
+                                         lv.base_player_idx))
+                nbytes = _nbytes(lv.width, lv.height)
+                for bits in (lv.wall_bits, lv.goal_bits, lv.base_box_bits):
+                    f.write(bits.to_bytes(nbytes, 'little'))
+            table = f.tell()
+            for off in offsets:
+                f.write(OFFSET.pack(off))
+            f.seek(0)  # level count and table are only known now
+            f.write(HEADER.pack(MAGIC, VERSION, size, mtime, maxs or 0,
+                                len(offsets), table))
+        os.replace(tmp, cache_path(filepath))
+    except OSError as e:
+        log.warning('could not write level cache %s: %s'
+                    % (cache_path(filepath), e))
+        return None
+    return len(offsets)
+
+
+class CompiledLevelSet:
+    """ Read-only sequence of the Levels of a cache file.
+    Levels are built on first access, then kept: they hold game state.
+    Levels can be read from other threads, eg to make thumbnails.
+    """
+
+    def __init__(self, path):
+        self._f = open(path, 'rb')
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        (_, _, self.source_size, self.source_mtime, maxs, self._count,
+         self._table) = HEADER.unpack_from(self._mm, 0)
+        self.maxs = maxs or None
+        self._levels = {}  # index -> Level, once materialized
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError('level index out of range')
+        level = self._levels.get(i)
+        if level is None:
+            # setdefault: a thread reading the same level gets the same one
+            level = self._levels.setdefault(i, self._read(i))
+        return level
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def record_bits(self, i):
+        """ (level number, (w, h, walls, goals, player, boxes)) of level i,
+        read from the file without building the Level, see Level.bits
+        """
+        off, = OFFSET.unpack_from(self._mm, self._table + i * OFFSET.size)
+        num, w, h, player = RECORD_HEAD.unpack_from(self._mm, off)
+        off += RECORD_HEAD.size
+        n = _nbytes(w, h)
+        walls, goals, boxes = [
+            int.from_bytes(self._mm[off + k * n:off + (k + 1) * n], 'little')
+            for k in range(3)]
+        return num, (w, h, walls, goals, player, boxes)
+
+    def _read(self, i):
+        num, bits = self.record_bits(i)
+        return Level.from_bits(num, *bits)
+
+    def close(self):
+        self._mm.close()
+        self._f.close()
+
+
+def _open_cache(filepath, maxs):
+    """ return the CompiledLevelSet of filepath, or None if its cache is
+    missing, unreadable, or stale.
+    """
+    path = cache_path(filepath)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(HEADER.size)
+        magic, version, size, mtime, cmaxs, _, _ = HEADER.unpack(head)
+    except (OSError, struct.error):
+        return None
+    if (magic, version, cmaxs) != (MAGIC, VERSION, maxs or 0):
+        return None
+    if (size, mtime) != _source_stamp(filepath):
+        return None
+    return CompiledLevelSet(path)
+
+
+def load_compiled_level_set(filepath, maxs=None):
+    """ like level.load_level_set, but through the cache.
+    return a sequence of levels, or None if cant load the file.
+    """
+    log = logging.getLogger('game')
+    if not os.path.isfile(filepath):
+        log.error('could not find level-set file %s' % filepath)
+        return None
+    levels = _open_cache(filepath, maxs)
+    if levels is not None:
+        return levels
+    log.info('compiling level set %s' % filepath)
+    if compile_level_set(filepath, maxs) is None:
+        return load_level_set(filepath, maxs)  # no cache, parse it all
+    return _open_cache(filepath, maxs)
+
+
+################# TESTS ##################
+
+
+def test_compiled_level_set():
+    filename = 'levelset.txt.test'
+    with open(filename, 'w') as f:
+        f.write('\n'.join(['#####', '#@$.#', '#####']) + '\n\n')
+        f.write('\n'.join(['#####', '#+ $#', '#$.*#', '#####']) + '\n\n')
+        f.write('\n'.join(['#' * 20, '#@$.' + ' ' * 15 + '#', '#' * 20]))
+    levels = load_level_set(filename)
+    compiled = load_compiled_level_set(filename)  # writes the cache
+    assert len(compiled) == 3
+    compiled.close()
+    compiled = load_compiled_level_set(filename)  # reads the cache
+    assert isinstance(compiled, CompiledLevelSet)
+    assert len(compiled) == 3 and not compiled._levels  # nothing built yet
+    num, bits = compiled.record_bits(1)
+    assert not compiled._levels  # read without building levels
+    assert num == 1 and bits == levels[1].bits()
+    for lv, clv in zip(levels, compiled):
+        assert lv.tiles == clv.tiles and lv.digest() == clv.digest()
+        assert lv.level_num == clv.level_num
+    assert compiled[2] is compiled[-1]  # levels are built once
+    assert compiled[2].width == 20  # records have the size of their level
+    compiled.close()
+    # a different max size makes the cache stale
+    assert _open_cache(filename, 16) is None
+    for path in (filename, cache_path(filename)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    test_compiled_level_set()
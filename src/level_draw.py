@@ -1,5 +1,6 @@
 from constants import TRANSPARENT, SWAL, SGOL, SFLR, SPLR, SBOX, SPR_ORDER
-from level import TWAL, TGOL, TBGL, TPGL
+from board import iter_bits
+from level import DIRMAP
 import pview
 import pygame as pg
 
@@ -20,37 +21,205 @@ def load_spritesheet(filename, spr_order, s):
     return d
     
     
-def draw_level(level, surf, sprites):
+def cell_size(level, surf):
+    """ size in pixels of a cell, for level to fit in surf """
+    w, h = surf.get_size()
+    return max(1, min(w // level.width, h // level.height))
+
+
+def level_origin(level, surf, s):
+    """ top left corner (x, y) of level, centered in surf with cells of
+    size s
+    """
+    w, h = surf.get_size()
+    return (w - s * level.width) // 2, (h - s * level.height) // 2
+
+
+class SpriteAtlas:
+    """ Sprites scaled to a cell size, converted to the display format
+    with an RLE colorkey, and kept for the next frames.
+    A few sizes are kept, so toggling fullscreen back and forth does not
+    scale sprites again.
+    """
+    max_sizes = 4
+
+    def __init__(self, sprites):
+        self.sprites = sprites  # unscaled, as returned by load_spritesheet
+        self._scaled = {}  # cell size -> {sprite name: surface}
+
+    def get(self, s):
+        """ return the mapping of sprite names to sprites of size s """
+        scaled = self._scaled.get(s)
+        if scaled is None:
+            if len(self._scaled) >= self.max_sizes:
+                self._scaled.pop(next(iter(self._scaled)))  # oldest size
+            scaled = {}
+            for n, img in self.sprites.items():
+                img = pg.transform.scale(img, (s, s)).convert()
+                img.set_colorkey(TRANSPARENT, pg.RLEACCEL)
+                scaled[n] = img
+            self._scaled[s] = scaled
+        return scaled
+
+
+def draw_background(level, surf, scaled_sprites, s):
+    """ draw walls, floor and goals of level onto surf, in cells of size s """
+    surf.fill((0, 0, 0))  # prefill around the level
+    ox, oy = level_origin(level, surf, s)
+    w, walls, goals = level.width, level.wall_bits, level.goal_bits
+    for i in range(level.width * level.height):
+        y, x = divmod(i, w)
+        rect = [ox + x * s, oy + y * s, s, s]
+        if walls >> i & 1:
+            surf.blit(scaled_sprites[SWAL], rect)
+        elif goals >> i & 1:
+            surf.blit(scaled_sprites[SGOL], rect)
+        else:
+            surf.blit(scaled_sprites[SFLR], rect)
+
+
+def draw_level(level, surf, atlas):
     """ draw level onto surf. 
     level is a Level.
     surf is a pygame surface of any size.
-    sprites is a dict mapping sprite name to sprite img
+    atlas is a SpriteAtlas
     """
-    surf.fill((0, 0, 0))  # prefill for non-square surf or fullscreen edges
-    w, h = surf.get_size()
-    maxs = len(level.tiles)  # assumes level is always square
-    s = min(w // maxs, h // maxs)  # this way, no need to use pview.T
-    rect = (s, s, 2 * s, 3 * s)
-    pg.draw.rect(surf, (155, 211, 155), rect)
-    scaled_sprites = {n: pg.transform.scale(img, (s, s)) 
-                      for n, img in sprites.items()}
-    # draw background
-    for y, row in enumerate(level.tiles):
-        for x, tile in enumerate(row):
-            rect = [x * s, y * s, s, s]
-            if tile == TWAL:
-                surf.blit(scaled_sprites[SWAL], rect)
-            elif tile in (TGOL, TBGL, TPGL):
-                surf.blit(scaled_sprites[SGOL], rect)
-            else:
-                surf.blit(scaled_sprites[SFLR], rect)
+    s = cell_size(level, surf)  # this way, no need to use pview.T
+    scaled_sprites = atlas.get(s)
+    draw_background(level, surf, scaled_sprites, s)
     # draw player and boxes
+    ox, oy = level_origin(level, surf, s)
     y, x = level.player
-    rect = [s * x, s * y, s, s]
+    rect = [ox + s * x, oy + s * y, s, s]
     surf.blit(scaled_sprites[SPLR], rect)
     for (y, x) in level.boxes:
-        rect = [s * x, s * y, s, s]
+        rect = [ox + s * x, oy + s * y, s, s]
         surf.blit(scaled_sprites[SBOX], rect)
+
+
+def _arrow_points(cx, cy, s, d):
+    dy, dx = DIRMAP[d]
+    tip = (cx + dx * s * .45, cy + dy * s * .45)
+    left = (cx - dx * s * .1 - dy * s * .35, cy - dy * s * .1 + dx * s * .35)
+    right = (cx - dx * s * .1 + dy * s * .35, cy - dy * s * .1 - dx * s * .35)
+    return [tip, left, right]
+
+
+class LevelView:
+    """ Draws a level with dirty rects instead of redrawing every frame.
+    The background (walls, floor, goals) is drawn once per level and
+    surface size, and kept in bg. Player, boxes and the hint arrow are
+    DirtySprites: draw() only repaints the cells they left or entered.
+    """
+
+    def __init__(self, atlas):
+        self.atlas = atlas  # a SpriteAtlas
+        self.bg = None
+        self.rebuilt = False  # whether the last draw() repainted everything
+        self._key = None  # (level, surface size) that bg was drawn for
+        self._group = pg.sprite.LayeredDirty()
+        self._player = None
+        self._boxes = {}  # cell index -> box sprite
+        self._arrow = None
+        self._arrow_at = None  # (pos, direction) of the arrow image
+        self._s = 0  # cell size
+        self._origin = (0, 0)  # top left corner of the level
+
+    def invalidate(self):
+        """ draw everything again at the next draw(), eg after the
+        resolution changed, or another scene drew over the screen.
+        """
+        self._key = None
+
+    def level_rect(self):
+        """ area of the surface covered by the level """
+        return pg.Rect(self._origin, (self._s * self._w, self._s * self._h))
+
+    def _cell_sprite(self, img, i, layer):
+        spr = pg.sprite.DirtySprite()
+        spr.image = img
+        spr.rect = pg.Rect(0, 0, self._s, self._s)
+        self._place(spr, i)
+        self._group.add(spr, layer=layer)
+        return spr
+
+    def _place(self, spr, i):
+        spr.rect.topleft = self._topleft(i)
+        spr.dirty = 1
+
+    def _build(self, level, surf):
+        s = self._s = cell_size(level, surf)
+        self._w, self._h = level.width, level.height
+        self._origin = level_origin(level, surf, s)
+        scaled = self.atlas.get(s)
+        self.bg = pg.Surface(surf.get_size()).convert()
+        draw_background(level, self.bg, scaled, s)
+        self._group.empty()
+        self._group.clear(surf, self.bg)
+        self._boxes = {i: self._cell_sprite(scaled[SBOX], i, 1)
+                       for i in iter_bits(level.box_bits)}
+        self._player = self._cell_sprite(scaled[SPLR], level.player_idx, 1)
+        self._arrow = self._cell_sprite(pg.Surface((s, s)).convert(), 0, 2)
+        self._arrow.image.set_colorkey(TRANSPARENT)
+        self._arrow.visible = 0
+        self._arrow_at = None
+        surf.blit(self.bg, (0, 0))
+
+    def _sync(self, level):
+        """ move sprites to where the level state says they are """
+        boxes = set(iter_bits(level.box_bits))
+        if self._player.rect.topleft != self._topleft(level.player_idx):
+            self._place(self._player, level.player_idx)
+        gone = [i for i in self._boxes if i not in boxes]
+        came = [i for i in boxes if i not in self._boxes]
+        for i, j in zip(gone, came):
+            spr = self._boxes.pop(i)
+            self._place(spr, j)
+            self._boxes[j] = spr
+
+    def _topleft(self, i):
+        y, x = divmod(i, self._w)
+        ox, oy = self._origin
+        return (ox + x * self._s, oy + y * self._s)
+
+    def _set_arrow(self, arrow):
+        """ arrow is None, or (pos, direction) """
+        spr = self._arrow
+        if arrow is None:
+            if spr.visible:
+                spr.visible = 0
+                spr.dirty = 1
+            return
+        if arrow != self._arrow_at:
+            (y, x), d = arrow
+            s = self._s
+            spr.image.fill(TRANSPARENT)
+            points = _arrow_points(s / 2, s / 2, s, d)
+            pg.draw.polygon(spr.image, (255, 220, 0), points)
+            pg.draw.polygon(spr.image, (0, 0, 0), points, max(1, s // 16))
+            self._arrow_at = arrow
+            self._place(spr, y * self._w + x)
+        if not spr.visible:
+            spr.visible = 1
+            spr.dirty = 1
+
+    def draw(self, level, surf, arrow=None):
+        """ bring surf up to date with level. 
+        arrow is None, or a push (box (y,x), direction) to point at.
+        return the list of rects of surf that changed.
+        """
+        key = (level, surf.get_size())
+        self.rebuilt = key != self._key
+        if self.rebuilt:
+            self._key = key
+            self._build(level, surf)
+        else:
+            self._sync(level)
+        self._set_arrow(arrow)
+        rects = self._group.draw(surf)
+        if self.rebuilt:
+            return [surf.get_rect()]
+        return rects
     
     
 ################# TESTS ################## 
@@ -83,7 +252,34 @@ def test_load_spritesheet():
         pass
 
 
-def test_draw_level():
+def test_sprite_atlas():
+    pg.init()
+    pg.display.set_mode((100, 100))
+    img = pg.Surface((8, 8))
+    img.fill((255, 0, 0))
+    atlas = SpriteAtlas({'red': img})
+    scaled = atlas.get(20)
+    assert scaled['red'].get_size() == (20, 20)
+    assert scaled['red'].get_at((19, 19)) == (255, 0, 0)
+    assert atlas.get(20) is scaled  # scaled once only
+    for s in range(1, 10):
+        atlas.get(s)
+    assert len(atlas._scaled) == SpriteAtlas.max_sizes
+    pg.quit()
+
+
+def test_level_origin():
+    from level import build_level_from_tiles
+    rows = ['#####', '#@$.#', '#####']
+    level = build_level_from_tiles([list(r) for r in rows])
+    surf = pg.Surface((100, 100))
+    s = cell_size(level, surf)
+    assert s == 20
+    assert level_origin(level, surf, s) == (0, 20)  # centered vertically
+
+
+def demo_draw_level():
+    """ interactive: draws until ESC. not collected by pytest. """
     # make a dummy level
     from level import Level
     tiles = [
@@ -97,7 +293,7 @@ def test_draw_level():
         "########"
         ]
     tiles = list(map(lambda r: list(r), tiles))
-    level = Level(tiles, [(3, 3), (4, 5)], (3, 2), [(3, 4), (4, 5)])
+    level = Level(0, tiles, [(3, 3), (4, 5)], (3, 2), [(3, 4), (4, 5)])
     
     # load sprites and canvas with pygame
     pg.init()
@@ -107,6 +303,7 @@ def test_draw_level():
     # sheet and expected order of images, flattened
     filename = '../assets/sokobalt_tilesheet_8px.png'
     sprites = load_spritesheet(filename, SPR_ORDER, 8)
+    atlas = SpriteAtlas(sprites)
     
     done = False
     while not done:
@@ -118,7 +315,7 @@ def test_draw_level():
             if event.type == pg.KEYDOWN and event.key == pg.K_F11:
                 pview.toggle_fullscreen()
         # draw every loop, kinda wasteful
-        draw_level(level, pview.screen, sprites)
+        draw_level(level, pview.screen, atlas)
         pg.display.flip()
     
     # tear down
@@ -127,5 +324,7 @@ def test_draw_level():
 
 if __name__ == "__main__":
     test_load_spritesheet()   
-    test_draw_level()  # press ESC or F11
+    test_sprite_atlas()
+    test_level_origin()
+    demo_draw_level()  # press ESC or F11
     
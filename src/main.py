@@ -1,13 +1,19 @@
-from constants import OUT_FSCR, OUT_QUIT
+from constants import BPRF, OUT_EXPOSE, OUT_FSCR, OUT_QUIT
 from controls import controller
+from frame_profiler import profiler
 from game_scene import GameScene
 import pview
 import pygame as pg
 
-from level import load_level_set
+from level_cache import load_compiled_level_set
 from menu_scene import MenuScene
+import ptext
 from scene import SCN_QUIT, SCN_GAME, SCN_MENU
+from solution_db import SolutionStore
 from settings import BASE_RES, FPS, LEVELS_FILENAME, LEVELS_MAXSIZE
+from settings import IDLE_WAIT
+from settings import PROFILE_TRACE, THUMB_SIZE
+from thumbnail import ThumbnailCache
 import logging.config
 
 
@@ -21,31 +27,49 @@ def main():
     log.info('Main started')
 
     # load levels
-    levels = load_level_set(LEVELS_FILENAME, LEVELS_MAXSIZE)  # list
+    # levels are parsed on first run, then read lazily from a cache
+    levels = load_compiled_level_set(LEVELS_FILENAME, LEVELS_MAXSIZE)
+    store = SolutionStore(LEVELS_FILENAME)  # solutions, for hints
 
     pg.init()
     pg.display.set_caption('Sokobalt')
     pview.set_mode(BASE_RES)
+    ptext.set_scale(pview.f)
     clock = pg.time.Clock()
+    # level previews are made in the background, or read from their atlas
+    thumbs = ThumbnailCache(levels, LEVELS_FILENAME, pview.T(THUMB_SIZE))
+    thumbs.start()
     scenes = {
-        SCN_MENU: MenuScene(levels),
-        SCN_GAME: GameScene(levels)
+        SCN_MENU: MenuScene(levels, thumbs),
+        SCN_GAME: GameScene(levels, store)
     }
     cur_scene = scenes[SCN_MENU]
 
     while True:
-        ms = clock.tick(FPS)  # throttle
+        # sleep until input, or until the scene has something to show
+        wait = cur_scene.wait_ms() if IDLE_WAIT else 0
+        if wait != 0:
+            controller.wait(wait)
+        ms = clock.tick(FPS)  # throttle, and time since the last tick
 
         # poll controls
-        outcome = controller.poll()  # get player input
+        with profiler.phase('input'):
+            outcome = controller.poll()  # get player input
         if outcome == OUT_QUIT:
             break
         elif outcome == OUT_FSCR:
             pview.toggle_fullscreen()
+            ptext.set_scale(pview.f)  # text of the old size is not reused
             cur_scene.redraw()
+        elif outcome == OUT_EXPOSE:
+            cur_scene.redraw()  # the screen may be black, or stale
+        if controller.btn_event(BPRF):
+            profiler.toggle()
 
         # tick scene
-        next_scene_id, kwargs = cur_scene.tick(ms)
+        with profiler.phase('logic'):
+            next_scene_id, kwargs = cur_scene.tick(ms)
+        profiler.end_frame()
         if next_scene_id == SCN_QUIT:  # quit via dummy scene constant
             break
         elif next_scene_id is not None:  # change scene
@@ -53,6 +77,12 @@ def main():
             cur_scene = scenes[next_scene_id]
             cur_scene.resume(**kwargs)
 
+    thumbs.stop()
+    log.debug('text caches (entries, bytes, hits, misses, evictions): %s'
+              % ptext.stats())
+    if profiler.dump(PROFILE_TRACE):
+        log.info('frame trace written to %s' % PROFILE_TRACE)
+
 
 if __name__ == "__main__":
     main()
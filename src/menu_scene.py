@@ -5,55 +5,71 @@ from pview import T
 import pview
 import pygame as pg
 from scene import Scene, SCN_GAME, SCN_QUIT
+from settings import IDLE_POLL_MS, THUMB_SIZE
 
 
 class MenuScene(Scene):
     """ Main menu.
     Show list of levels, player can select one and start playing.
+    A page of the level grid is rendered once into a surface, and kept
+    for a few pages: a frame is a blit of the page, and the pointer.
+    Nothing is drawn while the cursor does not move.
+    thumbs is an optional thumbnail.ThumbnailCache of the levels: a page
+    drawn before all its thumbnails were ready is drawn again as they come.
     """
+    max_pages = 8  # rendered pages kept
 
-    def __init__(self, levels):
+    def __init__(self, levels, thumbs=None):
         # selection logic and rendering constants and variables
         self._choice = 0  # TODO: should init at latest unlocked level
-        self._choices = [
-            ('L%d' % i, SCN_GAME, {'level': i})
-            for i in range(len(levels))
-        ]
+        self._n_levels = len(levels)
         self._page_w = 5  # number of levels per row
         self._page_h = 4  # number of rows per screen
-        blanks = self._page_w - (len(levels) % self._page_w)
-        self._choices += [('--', None, {})] * blanks  # pad last row with blanks
+        blanks = self._page_w - (self._n_levels % self._page_w)
+        self._n_choices = self._n_levels + blanks  # pad last row with blanks
 
         self._page_start_row = self._choice // self._page_w  # for pagination
 
         self._ongoing_level = None  # if player wants to resume current level
+        self._thumbs = thumbs
+        self._pages = {}  # (start row, screen size) -> (surface, made)
+        self._drawn = None  # (page key, choice) on screen
+
+    def wait_ms(self):
+        """ no frames until input, but while thumbnails are to come """
+        if self._drawn is None:
+            return 0
+        if self._pages.get(self._drawn[0], (None, None))[1] is not None:
+            return IDLE_POLL_MS  # the page on screen lacks thumbnails
+        return None
+
+    def _label(self, i):
+        """ text of choice i: a level number, or a blank """
+        return 'L%d' % i if i < self._n_levels else '--'
 
     def tick(self, ms):
         # process inputs: play selected level or quit
         if controller.btn_event(BSLC):
-            c = self._choices[self._choice]
-            if c[1] and c[2]['level'] == self._ongoing_level:
-                return SCN_GAME, {'resume_level': True}  # key matters, not value
-            else:
-                return c[1], c[2]
+            if self._choice < self._n_levels:
+                if self._choice == self._ongoing_level:
+                    return SCN_GAME, {'resume_level': True}  # key matters
+                return SCN_GAME, {'level': self._choice}
+            return None, {}  # blank
         if controller.btn_event(BMNU):  # press menu button when in menu: exit
             return SCN_QUIT, {}
 
         # process inputs: move level cursor
         cursor_row = self._choice // self._page_w
-        max_row = len(self._choices) // self._page_w - 1
+        max_row = self._n_choices // self._page_w - 1
         if controller.btn_event(BDWN) and cursor_row < max_row:
             self._choice += self._page_w
         elif controller.btn_event(BUPP) and cursor_row > 0:
             self._choice -= self._page_w
         elif controller.btn_event(BLFT) and self._choice > 0:
             self._choice -= 1
-        elif controller.btn_event(BRGT) and self._choice < len(self._choices)-1:
+        elif controller.btn_event(BRGT) and self._choice < self._n_choices-1:
             self._choice += 1
 
-        # draw bg
-        pview.fill((86, 55, 35))
-
         # adjust page start if needed
         cursor_row = self._choice // self._page_w
         cursor_col = self._choice % self._page_w
@@ -62,29 +78,75 @@ class MenuScene(Scene):
         if cursor_row < self._page_start_row:
             self._page_start_row -= 1
 
-        # draw level numbers
-        start_choice = self._page_start_row * self._page_w
-        end_choice = start_choice + self._page_h * self._page_w
-        visible_choices = self._choices[start_choice:end_choice]
-        for i, choice in enumerate(visible_choices):
-            x = 150 + (i % self._page_w) * 100
-            y = 150 + (i // self._page_w) * 100
-            ptext.draw(choice[0], T(x, y), fontsize=T(50), color=(185, 122, 87))
+        key = (self._page_start_row, pview.screen.get_size())
+        made = self._pages.get(key, (None, None))[1]
+        if made is not None and made != self._thumbs.made:
+            del self._pages[key]  # new thumbnails to show
+            self._drawn = None
+        if (key, self._choice) == self._drawn:
+            return None, {}  # screen is up to date
+        self._drawn = (key, self._choice)
+        pview.screen.blit(self._page(key), (0, 0))
 
         # draw pointer
         x = 115 + cursor_col * 100
         y = 140 + (cursor_row - self._page_start_row) * 100
         ptext.draw('>', T(x, y), fontsize=T(70), color=(0, 162, 232))
 
+        pg.display.flip()
+        return None, {}  # no next scene to return
+
+    def _page(self, key):
+        """ surface of the page of the grid starting at row key[0] """
+        if key in self._pages:
+            return self._pages[key][0]
+        made = None  # thumbnails made before the page is drawn
+        if self._thumbs is not None:
+            # the resolution may have changed while in another scene
+            self._thumbs.set_size(T(THUMB_SIZE))
+            made = self._thumbs.made  # the worker may make more meanwhile
+        if len(self._pages) >= self.max_pages:
+            self._pages.pop(next(iter(self._pages)))  # oldest page
+        surf = pg.Surface(key[1]).convert()
+        surf.fill((86, 55, 35))  # bg
+        missing = False  # thumbnails not ready yet
+
+        # draw level numbers
+        start_choice = key[0] * self._page_w
+        end_choice = min(start_choice + self._page_h * self._page_w,
+                         self._n_choices)
+        for i in range(start_choice, end_choice):
+            x = 150 + ((i - start_choice) % self._page_w) * 100
+            y = 150 + ((i - start_choice) // self._page_w) * 100
+            if self._thumbs is None:
+                ptext.draw(self._label(i), T(x, y), fontsize=T(50),
+                           color=(185, 122, 87), surf=surf)
+                continue
+            thumb = self._thumbs.get(i) if i < self._n_levels else None
+            if thumb is not None:  # centered in its square
+                tw, th = thumb.get_size()
+                tx, ty = T(x, y - 10)
+                pad = self._thumbs.size
+                surf.blit(thumb, (tx + (pad - tw) // 2, ty + (pad - th) // 2))
+            missing |= thumb is None and i < self._n_levels
+            ptext.draw(self._label(i), T(x, y + 56), fontsize=T(24),
+                       color=(185, 122, 87), surf=surf)
+
         # draw command tips
         ptext.draw('F11: toggle fullscreen\nEsc: quit', T(10, 10),
-                   fontsize=T(20), color=(185, 122, 87))
+                   fontsize=T(20), color=(185, 122, 87), surf=surf)
+        self._pages[key] = (surf, made if missing else None)
+        return surf
 
-        pg.display.flip()
-        return None, {}  # no next scene to return
+    def redraw(self):
+        """ resolution changed, or the window was uncovered: pages of the
+        old size are useless, and the screen is drawn again """
+        self._pages = {}
+        self._drawn = None
 
     def resume(self, **kwargs):
         """ called by scene manager from the game scene, passing kwargs. """
+        self._drawn = None  # the game scene drew over the screen
         self._choice = 0
         if kwargs.get('current_level'):
             level = kwargs['current_level']
@@ -92,6 +154,90 @@ class MenuScene(Scene):
             self._ongoing_level = level
 
 
+################# TESTS ##################
+
+
+def test_menu_pages():
+    import os
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    pg.init()
+    pview.set_mode((800, 600))
+    ptext.set_scale(pview.f)
+    scene = MenuScene(range(100))
+    assert scene._label(99) == 'L99' and scene._label(100) == '--'
+    scene.tick(16)
+    assert len(scene._pages) == 1
+    scene.tick(16)  # nothing moved: nothing drawn
+    scene._choice = 99
+    scene._page_start_row = 16  # last page
+    scene.tick(16)
+    assert len(scene._pages) == 2
+    for row in range(20):
+        scene._page_start_row = row
+        scene.tick(16)
+    assert len(scene._pages) == MenuScene.max_pages
+    scene.redraw()
+    assert not scene._pages
+    ptext.set_scale(None)  # fonts do not outlive pg.quit
+    pg.quit()
+
+
+def test_menu_thumbnails():
+    import os
+    from thumbnail import ThumbnailCache
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    pg.init()
+    pview.set_mode((800, 600))
+    ptext.set_scale(pview.f)
+    thumbs = ThumbnailCache(range(3), 'levelset.txt.test', T(THUMB_SIZE))
+    scene = MenuScene(range(3), thumbs)
+    scene.tick(16)
+    key = (0, (800, 600))
+    assert scene._pages[key][1] == 0  # drawn again when thumbnails come
+    thumbs.made = 3  # as if the worker had made them
+    thumbs._thumbs = {i: pg.Surface((8, 8)) for i in range(3)}
+    assert scene.wait_ms() == IDLE_POLL_MS
+    scene.tick(16)
+    assert scene._pages[key][1] is None  # complete
+    assert scene.wait_ms() is None
+    pview.set_mode(height=300)  # eg F11 in the game scene: no redraw()
+    scene.resume()
+    scene.tick(16)
+    assert thumbs.size == T(THUMB_SIZE) < THUMB_SIZE and thumbs.made == 0
+    ptext.set_scale(None)  # fonts do not outlive pg.quit
+    pg.quit()
+
+
+def test_menu_thumbnails_race():
+    """ thumbnails made while a page is drawn make it drawn again """
+    import os
+    from thumbnail import ThumbnailCache
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    pg.init()
+    pview.set_mode((800, 600))
+    ptext.set_scale(pview.f)
+    thumbs = ThumbnailCache(range(3), 'levelset.txt.test', T(THUMB_SIZE))
+    get = thumbs.get
+
+    def get_then_finish(i):
+        thumb = get(i)
+        thumbs.made = 3  # as if the worker made them all meanwhile
+        thumbs._thumbs = {j: pg.Surface((8, 8)) for j in range(3)}
+        return thumb
+
+    thumbs.get = get_then_finish
+    scene = MenuScene(range(3), thumbs)
+    scene.tick(16)
+    key = (0, pview.screen.get_size())
+    assert scene._pages[key][1] == 0
+    assert scene.wait_ms() == IDLE_POLL_MS
+    scene.tick(16)
+    assert scene._pages[key][1] is None  # drawn again, complete
+    assert scene.wait_ms() is None
+    ptext.set_scale(None)  # fonts do not outlive pg.quit
+    pg.quit()
+
+
 if __name__ == "__main__":
     def main():
         from settings import FPS, BASE_RES
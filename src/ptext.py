@@ -7,6 +7,7 @@
 
 from __future__ import division
 
+from collections import OrderedDict
 from math import ceil, sin, cos, radians, exp
 import pygame
 
@@ -30,12 +31,67 @@ ALPHA_RESOLUTION = 16
 ANGLE_RESOLUTION_DEGREES = 3
 
 AUTO_CLEAN = True
-MEMORY_LIMIT_MB = 64
+MEMORY_LIMIT_MB = 64  # for rendered text surfaces
 MEMORY_REDUCTION_FACTOR = 0.5
+# limits of the smaller caches, and estimated bytes per entry
+FONT_CACHE_MB, FONT_BYTES = 4, 1 << 16
+MISC_CACHE_MB, ENTRY_BYTES = 1, 64
 
 pygame.font.init()
 
-_font_cache = {}
+
+class _Cache(object):
+    """Least recently used mapping, bounded by an estimate of its bytes.
+    sizeof(value) is the number of bytes a value is accounted for."""
+
+    def __init__(self, name, max_bytes, sizeof):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self._data.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self._data:
+            self.nbytes -= self.sizeof(self._data.pop(key))
+        self._data[key] = value
+        self.nbytes += self.sizeof(value)
+        if self.nbytes > self.max_bytes:
+            self.shrink(self.max_bytes * MEMORY_REDUCTION_FACTOR)
+
+    def shrink(self, max_bytes):
+        """Evict the least recently used entries, down to max_bytes."""
+        while self._data and self.nbytes > max_bytes:
+            _, value = self._data.popitem(last=False)
+            self.nbytes -= self.sizeof(value)
+            self.evictions += 1
+
+    def clear(self):
+        self.shrink(0)
+
+
+def _surfbytes(surf):
+    w, h = surf.get_size()
+    return 4 * w * h
+
+
+_font_cache = _Cache("font", FONT_CACHE_MB << 20, lambda font: FONT_BYTES)
 
 
 def getfont(fontname=None, fontsize=None, sysfontname=None,
@@ -45,7 +101,8 @@ def getfont(fontname=None, fontsize=None, sysfontname=None,
     if fontname is None and sysfontname is None: fontname = DEFAULT_FONT_NAME
     if fontsize is None: fontsize = DEFAULT_FONT_SIZE
     key = fontname, fontsize, sysfontname, bold, italic, underline
-    if key in _font_cache: return _font_cache[key]
+    font = _font_cache.get(key)
+    if font is not None: return font
     if sysfontname is not None:
         font = pygame.font.SysFont(sysfontname, fontsize, bold or False, italic or False)
     else:
@@ -60,7 +117,7 @@ def getfont(fontname=None, fontsize=None, sysfontname=None,
         font.set_italic(italic)
     if underline is not None:
         font.set_underline(underline)
-    _font_cache[key] = font
+    _font_cache.put(key, font)
     return font
 
 
@@ -125,12 +182,13 @@ def wrap(text, fontname=None, fontsize=None, sysfontname=None,
     return lines
 
 
-_fit_cache = {}
+_fit_cache = _Cache("fit", MISC_CACHE_MB << 20, lambda size: ENTRY_BYTES)
 
 
 def _fitsize(text, fontname, sysfontname, bold, italic, underline, width, height, lineheight, pspace, strip):
     key = text, fontname, sysfontname, bold, italic, underline, width, height, lineheight, pspace, strip
-    if key in _fit_cache: return _fit_cache[key]
+    fontsize = _fit_cache.get(key)
+    if fontsize is not None: return fontsize
 
     def fits(fontsize):
         texts = wrap(text, fontname, fontsize, sysfontname, bold, italic, underline, width, strip)
@@ -154,7 +212,7 @@ def _fitsize(text, fontname, sysfontname, bold, italic, underline, width, height
             else:
                 b = c
         fontsize = a
-    _fit_cache[key] = fontsize
+    _fit_cache.put(key, fontsize)
     return fontsize
 
 
@@ -190,15 +248,17 @@ def _resolveangle(angle):
 
 
 # Return the set of points in the circle radius r, using Bresenham'scene circle algorithm
-_circle_cache = {}
+_circle_cache = _Cache("circle", MISC_CACHE_MB << 20,
+                       lambda points: 16 * len(points) + ENTRY_BYTES)
 
 
 def _circlepoints(r):
     r = int(round(r))
-    if r in _circle_cache:
-        return _circle_cache[r]
+    points = _circle_cache.get(r)
+    if points is not None:
+        return points
     x, y, e = r, 0, 1 - r
-    _circle_cache[r] = points = []
+    points = []
     while x >= y:
         points.append((x, y))
         y += 1
@@ -211,14 +271,15 @@ def _circlepoints(r):
     points += [(-x, y) for x, y in points if x]
     points += [(x, -y) for x, y in points if y]
     points.sort()
+    _circle_cache.put(r, points)
     return points
 
 
-_surf_cache = {}
-_surf_tick_usage = {}
-_surf_size_total = 0
-_unrotated_size = {}
-_tick = 0
+_surf_cache = _Cache("surf", MEMORY_LIMIT_MB << 20, _surfbytes)
+_unrotated_size = _Cache("unrotated", MISC_CACHE_MB << 20,
+                         lambda size: ENTRY_BYTES)
+_caches = [_surf_cache, _font_cache, _fit_cache, _circle_cache, _unrotated_size]
+_scale = None
 
 
 def getsurf(text, fontname=None, fontsize=None, sysfontname=None, bold=None, italic=None,
@@ -226,7 +287,6 @@ def getsurf(text, fontname=None, fontsize=None, sysfontname=None, bold=None, ita
             background=None, antialias=True, ocolor=None, owidth=None, scolor=None, shadow=None,
             gcolor=None, shade=None, alpha=1.0, align=None, lineheight=None, pspace=None, angle=0,
             cache=True):
-    global _tick, _surf_size_total
     if fontname is None: fontname = DEFAULT_FONT_NAME
     if fontsize is None: fontsize = DEFAULT_FONT_SIZE
     fontsize = int(round(fontsize))
@@ -252,10 +312,9 @@ def getsurf(text, fontname=None, fontsize=None, sysfontname=None, bold=None, ita
     key = (text, fontname, fontsize, sysfontname, bold, italic, underline, width, widthem, strip,
            color, background, antialias, ocolor, opx, scolor, spx, gcolor, alpha, align, lineheight,
            pspace, angle)
-    if key in _surf_cache:
-        _surf_tick_usage[key] = _tick
-        _tick += 1
-        return _surf_cache[key]
+    surf = _surf_cache.get(key)
+    if surf is not None:
+        return surf
     texts = wrap(text, fontname, fontsize, sysfontname, bold, italic, underline,
                  width=width, widthem=widthem, strip=strip)
     if angle:
@@ -267,7 +326,7 @@ def getsurf(text, fontname=None, fontsize=None, sysfontname=None, bold=None, ita
             surf = pygame.transform.rotate(surf0, angle)
         else:
             surf = pygame.transform.rotozoom(surf0, angle, 1.0)
-        _unrotated_size[(surf.get_size(), angle, text)] = surf0.get_size()
+        _unrotated_size.put((surf.get_size(), angle, text), surf0.get_size())
     elif alpha < 1.0:
         surf0 = getsurf(text, fontname, fontsize, sysfontname, bold, italic, underline,
                         width, widthem, strip, color, background, antialias,
@@ -347,11 +406,7 @@ def getsurf(text, fontname=None, fontsize=None, sysfontname=None, bold=None, ita
                 x = int(round(align * (w - lsurf.get_width())))
                 surf.blit(lsurf, (x, y))
     if cache:
-        w, h = surf.get_size()
-        _surf_size_total += 4 * w * h
-        _surf_cache[key] = surf
-        _surf_tick_usage[key] = _tick
-        _tick += 1
+        _surf_cache.put(key, surf)
     return surf
 
 
@@ -408,7 +463,13 @@ def draw(text, pos=None,
                     align, lineheight, pspace, angle, cache)
     angle = _resolveangle(angle)
     if angle:
-        w0, h0 = _unrotated_size[(tsurf.get_size(), angle, text)]
+        size0 = _unrotated_size.get((tsurf.get_size(), angle, text))
+        if size0 is None:  # evicted: size of the text before rotation
+            size0 = getsurf(text, fontname, fontsize, sysfontname, bold, italic, underline, width,
+                            widthem, strip, color, background, antialias, ocolor, owidth, scolor,
+                            shadow, gcolor, shade, alpha, align, lineheight, pspace, 0,
+                            cache).get_size()
+        w0, h0 = size0
         S, C = sin(radians(angle)), cos(radians(angle))
         dx, dy = (0.5 - hanchor) * w0, (0.5 - vanchor) * h0
         x += dx * C + dy * S - 0.5 * tsurf.get_width()
@@ -446,17 +507,62 @@ def drawbox(text, rect, fontname=None, sysfontname=None, lineheight=None, pspace
 
 
 def clean():
-    global _surf_size_total
-    memory_limit = MEMORY_LIMIT_MB * (1 << 20)
-    if _surf_size_total < memory_limit:
-        return
-    memory_limit *= MEMORY_REDUCTION_FACTOR
-    keys = sorted(_surf_cache, key=_surf_tick_usage.get)
-    for key in keys:
-        w, h = _surf_cache[key].get_size()
-        del _surf_cache[key]
-        del _surf_tick_usage[key]
-        _surf_size_total -= 4 * w * h
-        if _surf_size_total < memory_limit:
-            break
-
+    """Bring every cache under its memory limit."""
+    for c in _caches:
+        c.shrink(c.max_bytes)
+
+
+def set_scale(scale):
+    """Text is drawn at a new scale, eg pview.f after a resolution change.
+    Entries are not keyed by scale, so when it changes every cache is
+    cleared, fonts and surfaces alike, including text of sizes that did
+    not change."""
+    global _scale
+    if scale != _scale:
+        if _scale is not None:
+            for c in _caches:
+                c.clear()
+        _scale = scale
+
+
+def stats():
+    """Dict of cache name: (entries, bytes, hits, misses, evictions)."""
+    return dict((c.name, (len(c), c.nbytes, c.hits, c.misses, c.evictions))
+                for c in _caches)
+
+
+################# TESTS ##################
+
+
+def test_cache():
+    c = _Cache("test", 100, lambda v: v)
+    c.put("a", 40)
+    c.put("b", 40)
+    assert c.get("a") == 40 and c.get("x") is None  # "a" is now most recent
+    c.put("c", 40)  # over the limit: evict down to half of it
+    assert "a" not in c and "b" not in c and "c" in c
+    assert (c.hits, c.misses, c.evictions, c.nbytes) == (1, 1, 2, 40)
+
+
+def test_set_scale():
+    pygame.init()
+    pygame.display.set_mode((100, 100))
+    set_scale(1)
+    hits = _surf_cache.hits  # counters are kept across scales
+    draw("hello", (0, 0), fontsize=20)
+    draw("hello", (0, 0), fontsize=20)
+    assert stats()["surf"][:3] == (1, _surf_cache.nbytes, hits + 1)
+    set_scale(1)  # same scale: nothing forgotten
+    assert len(_surf_cache) == 1
+    set_scale(2)
+    assert len(_surf_cache) == 0 and len(_font_cache) == 0
+    draw("tilted", (50, 50), fontsize=20, angle=30)
+    _unrotated_size.clear()
+    draw("tilted", (50, 50), fontsize=20, angle=30)  # size rendered again
+    set_scale(None)  # fonts do not outlive pygame.quit
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    test_cache()
+    test_set_scale()
@@ -0,0 +1,137 @@
+""" Replay stored solutions through the game engine, without pygame.
+Each level of a level set is reset, its stored moves are played with
+Level.move, and the level must end up complete. Moves come from the
+solution store next to the level-set file (see solution_db.py), or from
+a JSON lines file with 'digest' and 'lurd' fields, eg batch_solve output.
+Run from the src folder, eg:
+    python replay.py ../assets/levels_microban.txt
+Exits with status 1 if any stored solution does not solve its level.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from level import load_level_set
+from solution_db import SolutionStore
+
+
+def replay(level, lurd):
+    """ play lurd from the start of level. return true if it solves it """
+    return level.play_lurd(lurd) and level.is_complete()
+
+
+def read_solutions(filename):
+    """ return a dict of digest -> LURD string from a JSON lines file """
+    solutions = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+                if r.get('lurd'):
+                    solutions[r['digest']] = r['lurd']
+            except (ValueError, KeyError):
+                pass  # not a solution record
+    return solutions
+
+
+def replay_level_set(levels, solutions):
+    """ replay the solution of each level found in solutions, a mapping
+    of digest to LURD string, or an object with a get(digest) method
+    returning solution records.
+    return (n_replayed, list of level numbers that failed, n_moves).
+    """
+    n_replayed = n_moves = 0
+    failed = []
+    for level in levels:
+        sol = solutions.get(level.digest())
+        if sol is None:
+            continue
+        lurd = sol['lurd'] if isinstance(sol, dict) else sol
+        n_replayed += 1
+        n_moves += len(lurd)
+        if not replay(level, lurd):
+            failed.append(level.level_num)
+        level.reset()
+    return n_replayed, failed, n_moves
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('files', nargs='+', help='level-set files')
+    p.add_argument('--solutions', default=None,
+                   help='JSON lines file of solutions, instead of the '
+                        'solution store of each level set')
+    p.add_argument('--maxsize', type=int, default=None,
+                   help='maximum width and height of a level (default: any)')
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    log = logging.getLogger('game')
+    shared = read_solutions(args.solutions) if args.solutions else None
+    n_total = n_moves = 0
+    n_failed = 0
+    seconds = 0
+    for path in args.files:
+        levels = load_level_set(path, args.maxsize)
+        if levels is None:
+            return 2
+        solutions = shared if shared is not None else SolutionStore(path)
+        t0 = time.perf_counter()
+        n, failed, moves = replay_level_set(levels, solutions)
+        seconds += time.perf_counter() - t0
+        for level_num in failed:
+            log.error('%s: level %d is not solved by its stored moves'
+                      % (path, level_num))
+        log.info('%s: %d of %d levels replayed, %d failed'
+                 % (path, n, len(levels), len(failed)))
+        n_total += n
+        n_moves += moves
+        n_failed += len(failed)
+    if seconds > 0:
+        log.info('%d replays in %.3fs: %.0f replays/s, %.0f moves/s'
+                 % (n_total, seconds, n_total / seconds, n_moves / seconds))
+    return 1 if n_failed else 0
+
+
+################# TESTS ##################
+
+
+def test_replay():
+    import os
+    filename = 'levelset.txt.test'
+    with open(filename, 'w') as f:
+        f.write('\n'.join(['#####', '#@$.#', '#####']) + '\n\n')
+        f.write('\n'.join(['######', '#@$ .#', '######']) + '\n')
+    levels = load_level_set(filename)
+    solutions = {levels[0].digest(): 'R', levels[1].digest(): 'RR'}
+    assert replay_level_set(levels, solutions) == (2, [], 3)
+    solutions[levels[1].digest()] = 'Rr'  # case is not checked
+    assert replay_level_set(levels, solutions)[1] == []
+    solutions[levels[1].digest()] = 'R'  # one push short
+    assert replay_level_set(levels, solutions)[1] == [1]
+    assert levels[1].n_moves == 0  # levels are reset after their replay
+    with open(filename + '.sol', 'w') as f:
+        for level in levels:
+            rec = {'digest': level.digest(), 'lurd': 'R' * (level.width - 4)}
+            f.write(json.dumps(rec) + '\n')
+    assert main([filename, '--solutions', filename + '.sol']) == 0
+    for path in (filename, filename + '.sol'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def test_no_pygame():
+    """ the runner must work where pygame is not installed """
+    import subprocess
+    code = 'import sys, replay; assert "pygame" not in sys.modules'
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -22,5 +22,12 @@ class Scene():
         """ Scene is active again. """
         pass
     def redraw(self):
-        """ Player fullscreened and scene needs to be redrawn from scratch. """
-        pass
\ No newline at end of file
+        """ Player fullscreened, or the window was uncovered, and scene
+        needs to be redrawn from scratch. """
+        pass
+    def wait_ms(self):
+        """ How long the main loop can sleep, waiting for player input,
+        before the next tick: None until there is input, 0 for no sleep,
+        eg while animating. Scenes that do not say get continuous frames.
+        """
+        return 0
\ No newline at end of file
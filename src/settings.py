@@ -1,8 +1,11 @@
-from constants import BSLC, BDWN, BUPP, BLFT, BRGT, BRST, BMNU
+from constants import BSLC, BDWN, BUPP, BLFT, BRGT, BRST, BMNU, BHNT
+from constants import BUND, BRDO, BPRF
 import pygame as pg
 
 
 FPS = 30
+IDLE_WAIT = True  # sleep until input when nothing moves on screen
+IDLE_POLL_MS = 100  # how often to check for background work when idle
 DEBUG = True
 BASE_RES = 800, 600  # height should ideally be a multiple of 8
 
@@ -12,7 +15,14 @@ SPR_SIZE = 8  # size of sprites, in pixels. Sprites must be square.
 # LEVELS_FILENAME = '../assets/levels_test.txt'
 # LEVELS_FILENAME = '../assets/maps_after_all.txt'
 LEVELS_FILENAME = '../assets/levels_microban.txt'
-LEVELS_MAXSIZE = 16  # maximum width and height of a level
+LEVELS_MAXSIZE = None  # maximum width and height of a level, None for any
+THUMB_SIZE = 64  # size of the level thumbnails of the menu, at BASE_RES
+
+HINT_SECONDS = 10  # give up searching for a hint after that long
+HINT_BLINK_MS = 300  # hint arrow is shown, then hidden, for that long
+
+PROFILE_REFRESH_MS = 500  # how often frame time stats are redrawn
+PROFILE_TRACE = 'frames.trace.json'  # written on exit, if F3 was pressed
 
 # map button to keys
 bmap = {
@@ -22,7 +32,11 @@ bmap = {
     BLFT: [pg.K_a, pg.K_LEFT],
     BRGT: [pg.K_d, pg.K_RIGHT],
     BRST: [pg.K_r],
-    BMNU: [pg.K_ESCAPE]
+    BMNU: [pg.K_ESCAPE],
+    BHNT: [pg.K_h],
+    BUND: [pg.K_z, pg.K_BACKSPACE],
+    BRDO: [pg.K_y],
+    BPRF: [pg.K_F3]
     }
 
 # map keys to button, eg K_d -> 'right'
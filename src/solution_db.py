@@ -0,0 +1,176 @@
+""" On-disk store of level solutions, next to the level-set file.
+Records are JSON lines appended to <level file>.solutions.
+The index <level file>.solutions.idx maps each Level.digest() to the byte
+offset of its latest record, so startup only reads the index, and a lookup
+reads a single line.
+"""
+import json
+import logging
+import os
+from board import reachable
+from constants import DIRN, DIRS, DIRE, DIRW
+from solver import pushes_to_lurd, ANY, PUSHES
+
+
+# push directions are stored as single letters
+_DIR_CHARS = {DIRN: 'N', DIRS: 'S', DIRE: 'E', DIRW: 'W'}
+_CHAR_DIRS = {c: d for d, c in _DIR_CHARS.items()}
+
+
+def record_from_result(level, res, method='astar', objective=PUSHES):
+    """ solution record for level, from a solved solver.SearchResult.
+    objective is what the search minimized: the solution is optimal for
+    it, unless it is solver.ANY.
+    Pushes are relative to the level's starting position, so level must
+    be in its starting position.
+    """
+    lurd = pushes_to_lurd(level, res.pushes)
+    return {
+        'digest': level.digest(),
+        'level_num': level.level_num,
+        'pushes': [[y, x, _DIR_CHARS[d]] for (y, x), d in res.pushes],
+        'lurd': lurd,
+        'n_pushes': len(res.pushes),
+        'n_moves': len(lurd),
+        'optimal': objective != ANY,
+        'objective': objective,
+        'method': method,
+        'nodes': res.nodes,
+        'seconds': round(res.seconds, 3),
+    }
+
+
+class SolutionStore:
+    """ Solutions of a level set, keyed by level digest. """
+
+    def __init__(self, levels_filename):
+        self.data_path = levels_filename + '.solutions'
+        self.index_path = self.data_path + '.idx'
+        self._index = {}  # digest -> byte offset in the data file
+        self._dirty = False
+        self._load_index()
+
+    def _load_index(self):
+        """ read the index, or rebuild it if missing or out of date """
+        log = logging.getLogger('game')
+        if not os.path.isfile(self.data_path):
+            return
+        size = os.path.getsize(self.data_path)
+        try:
+            with open(self.index_path, 'r') as f:
+                idx = json.load(f)
+            if idx['size'] == size:
+                self._index = idx['offsets']
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        log.info('rebuilding solution index %s' % self.index_path)
+        with open(self.data_path, 'rb') as f:
+            offset = 0
+            for line in f:
+                try:
+                    self._index[json.loads(line)['digest']] = offset
+                except (ValueError, KeyError):
+                    log.warning('bad solution record at byte %d of %s'
+                                % (offset, self.data_path))
+                offset += len(line)
+        self._dirty = True
+        self.flush()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, digest):
+        return digest in self._index
+
+    def get(self, digest):
+        """ return the record of digest, or None """
+        offset = self._index.get(digest)
+        if offset is None:
+            return None
+        with open(self.data_path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def put(self, record):
+        """ append record, replacing any older record of the same level.
+        The index is only written to disk by flush().
+        """
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode()
+        with open(self.data_path, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            self._index[record['digest']] = f.tell()
+            f.write(line)
+        self._dirty = True
+
+    def flush(self):
+        """ write the index atomically """
+        if not self._dirty:
+            return
+        size = os.path.getsize(self.data_path)
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'size': size, 'offsets': self._index}, f)
+        os.replace(tmp, self.index_path)
+        self._dirty = False
+
+    def hint(self, level):
+        """ return the next push (box (y,x), direction) of the stored
+        solution, if the current state of level is on its way.
+        None if the level is unknown, or the player went off the solution.
+        """
+        rec = self.get(level.digest())
+        if rec is None:
+            return None
+        w, walls = level.width, level.wall_bits
+        boxes = level.base_box_bits
+        reach = None
+        for y, x, c in rec['pushes']:
+            b, d = y * w + x, _CHAR_DIRS[c]
+            delta = level.deltas[d]
+            if boxes == level.box_bits:
+                if reach is None:
+                    reach = reachable(level.player_idx, ~(walls | boxes), w)
+                if reach >> (b - delta) & 1:
+                    return (y, x), d
+            boxes ^= 1 << b | 1 << (b + delta)
+        return None
+
+
+################# TESTS ##################
+
+
+def test_solution_store():
+    from level import build_level_from_tiles
+    from solver import solve
+    filename = 'levelset.txt.test'
+    rows = ['######', '#@$ .#', '######']
+    level = build_level_from_tiles([list(r) for r in rows], 16)
+    res = solve(level)
+    store = SolutionStore(filename)
+    store.put(record_from_result(level, res))
+    store.flush()
+    # reopen: the index is read back from disk
+    store = SolutionStore(filename)
+    assert level.digest() in store
+    rec = store.get(level.digest())
+    assert rec['n_pushes'] == 2 and rec['lurd'] == 'RR'
+    assert rec['n_moves'] == 2 and rec['optimal']
+    assert store.hint(level) == ((1, 2), DIRE)
+    level.move(DIRE)
+    assert store.hint(level) == ((1, 3), DIRE)
+    level.reset()
+    # a stale index is rebuilt from the records
+    with open(store.index_path, 'w') as f:
+        f.write('{}')
+    store = SolutionStore(filename)
+    assert store.get(level.digest())['n_pushes'] == 2
+    for path in (store.data_path, store.index_path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    test_solution_store()
@@ -0,0 +1,645 @@
+""" Push-level sokoban solver.
+A search node is a box configuration plus the area the player can walk to
+without pushing anything. Expanding a node generates every legal push from
+that area, so player steps between pushes are never searched.
+When minimizing moves, the node is the cell the player stands on instead
+of its area, and a push costs the steps to walk to the box, plus one.
+The solution is a list of pushes, see pushes_to_moves to replay it.
+"""
+from heapq import heappush, heappop
+import logging
+import time
+from board import (iter_bits, lowest, player_area, popcount, reachable,
+                   to_pos)
+from constants import DIRN, DIRS, DIRE, DIRW, LURD
+from deadlock import corridor_stuck, is_frozen, stuck_boxes
+from heuristic import Matching, UNREACHABLE, nearest_goal_distances
+from zobrist import TranspositionTable, LRU, DEPTH
+
+
+DIRECTIONS = (DIRN, DIRS, DIRE, DIRW)
+
+# reasons a search stopped
+SOLVED, UNSOLVABLE = 'solved', 'unsolvable'
+NODE_LIMIT, TIME_LIMIT = 'node limit', 'time limit'
+MEMORY_LIMIT, CANCELLED = 'memory limit', 'cancelled'
+
+# what a solution minimizes. ANY takes the first solution found
+PUSHES, MOVES, ANY = 'pushes', 'moves', 'any'
+
+# lower bounds on the pushes left, see heuristic.py
+MATCHING, NEAREST = 'matching', 'nearest'
+
+# rough size of one stored node: table entry, parent link, heap entry
+# with its Matching
+NODE_BYTES = 600
+
+
+class SearchResult:
+    """ Outcome of a search.
+    pushes is a list of (box position, direction) if solved, None otherwise.
+    box position is the (y,x) of the box before it is pushed.
+    """
+
+    def __init__(self, status, pushes, nodes, seconds):
+        self.status = status
+        self.pushes = pushes
+        self.nodes = nodes  # number of expanded nodes
+        self.seconds = seconds
+
+    @property
+    def solved(self):
+        return self.status == SOLVED
+
+    def __repr__(self):
+        n = len(self.pushes) if self.pushes is not None else '-'
+        return ('<SearchResult %s, %s pushes, %d nodes, %.3fs>'
+                % (self.status, n, self.nodes, self.seconds))
+
+
+class Search:
+    """ Search state shared by the best-first and IDA* drivers.
+    objective is what a solution minimizes: PUSHES, MOVES, or nothing for
+    ANY, a greedy search that returns the first solution it finds.
+    Limits are optional: None means unlimited.
+    max_memory is in megabytes. It bounds the transposition table,
+    and the search stops when the estimated memory held by
+    stored nodes goes over it.
+    States are identified by a zobrist key of the boxes and of the
+    lowest cell of the player's area, see key(), or of the player's cell
+    when minimizing moves.
+    heuristic is MATCHING or NEAREST. NEAREST is only admissible with
+    as many boxes as goals, so MATCHING is used otherwise.
+    cancel is an optional threading.Event, to stop the search from
+    another thread.
+    finishes is an optional mapping of state_key to the list of
+    (box index, direction) pushes known to solve the level from that
+    state, eg from earlier searches: reaching one of them ends the search.
+    Only for ANY, since the rest of the solution may not be the shortest.
+    """
+
+    def __init__(self, level, max_nodes=None, max_seconds=None,
+                 max_memory=None, heuristic=MATCHING, cancel=None,
+                 objective=PUSHES, finishes=None):
+        if objective not in (PUSHES, MOVES, ANY):
+            raise ValueError('unknown objective %s' % objective)
+        if finishes and objective != ANY:
+            raise ValueError('known finishes only make sense with ANY')
+        self.finishes = finishes or {}
+        self.level = level
+        self.objective = objective
+        self.w = level.width
+        self.walls = level.wall_bits
+        self.goals = level.goal_bits
+        self.keys = level.zobrist
+        self.deltas = [(d, level.deltas[d]) for d in DIRECTIONS]
+        self.dead = level.dead_bits
+        self.squares = level.freeze_squares
+        self.corridors = level.corridors
+        # floor inside the walls, where corrals can be
+        self.floor = reachable(level.player_idx, ~self.walls, self.w)
+        self.surplus = level.surplus
+        self.tables = level.goal_distances
+        if heuristic == NEAREST and len(self.tables) < len(level.boxes):
+            heuristic = MATCHING
+        self.heuristic = heuristic
+        self.nearest = nearest_goal_distances(self.tables)
+        self.max_nodes = max_nodes
+        self.max_seconds = max_seconds
+        self.cancel = cancel
+        self.max_stored = None
+        self.table_size = None  # unbounded transposition table
+        if max_memory is not None:
+            self.max_stored = int(max_memory * 1024 * 1024 // NODE_BYTES)
+            self.table_size = max(1, self.max_stored // 2)
+        self.nodes = 0
+        self.t0 = time.time()
+
+    def estimate(self, boxes):
+        """ return a lower bound h on the pushes left, and the data needed
+        to update it after a push. h is UNREACHABLE or more if some goal
+        can never get a box.
+        Each push is at least a move, so h also bounds the moves left.
+        """
+        if self.heuristic == NEAREST:
+            return sum(self.nearest[b] for b in iter_bits(boxes)), None
+        m = Matching(self.tables, list(iter_bits(boxes)))
+        return m.cost, m
+
+    def update_estimate(self, h, est, b, b2):
+        """ return estimate() after the box at cell b moved to cell b2 """
+        if self.heuristic == NEAREST:
+            return h - self.nearest[b] + self.nearest[b2], None
+        m = est.moved(b, b2)
+        return m.cost, m
+
+    def normalize(self, player, boxes):
+        """ return the reach of the player, and its lowest cell index,
+        which identifies the area the player is in.
+        """
+        return player_area(player, ~(self.walls | boxes), self.w)
+
+    def key(self, box_hash, player, norm):
+        """ state hash: the area of the player is enough to count pushes,
+        but moves depend on the cell the player stands on.
+        """
+        if self.objective == MOVES:
+            return box_hash ^ self.keys.player[player]
+        return box_hash ^ self.keys.player[norm]
+
+    def pushes(self, boxes, box_hash, reach):
+        """ yield (box index, direction, new boxes, new box hash)
+        for each legal push that does not lead to a known deadlock.
+        With surplus boxes, pushes to dead squares are allowed, and the
+        whole position is checked instead.
+        """
+        walls, goals, squares = self.walls, self.goals, self.squares
+        dead, surplus, corridors = self.dead, self.surplus, self.corridors
+        blocked = walls | boxes | (0 if surplus else dead)
+        kbox = self.keys.box
+        moves = self.corral_pushes(boxes, reach)
+        if moves is None:
+            moves = [(b, d, delta) for b in iter_bits(boxes)
+                     for d, delta in self.deltas]
+        for b, d, delta in moves:
+            b2 = b + delta
+            if not reach >> (b - delta) & 1 or blocked >> b2 & 1:
+                continue
+            new_boxes = boxes ^ (1 << b | 1 << b2)
+            stuck = corridors[b2] and corridor_stuck(b2, b, new_boxes,
+                                                     corridors)
+            if surplus:
+                stuck |= stuck_boxes(new_boxes, walls, goals, dead, squares)
+                if popcount(stuck) > surplus:
+                    continue
+            elif stuck or is_frozen(b2, new_boxes, walls, goals, squares):
+                continue
+            yield b, d, new_boxes, box_hash ^ kbox[b] ^ kbox[b2]
+
+    def corral_pushes(self, boxes, reach):
+        """ return the pushes worth trying from the state, as a list of
+        (box index, direction, delta), or None to try them all.
+        A corral is an area the player can not get to, fenced by walls and
+        boxes. When every fence box can only be pushed into the corral, by
+        the player from where it stands (a PI-corral), and the corral is
+        not done, a solution must push one of them in before any other
+        box can matter: those pushes are tried first, and alone, which
+        keeps solutions with the fewest pushes, not with the fewest moves.
+        An empty list is a corral that can never be entered.
+        """
+        if self.surplus or self.objective == MOVES:
+            return None
+        free = self.floor & ~(boxes | reach)
+        w, walls, goals = self.w, self.walls, self.goals
+        best = None
+        while free:
+            corral = reachable(lowest(free), free, w)
+            free &= ~corral
+            fence = boxes & (corral << 1 | corral >> 1 | corral << w
+                             | corral >> w)
+            if not (fence & ~goals or corral & goals):
+                continue  # nothing left to do in there
+            fixed = walls | fence  # until a fence box is pushed
+            pushes = []
+            for b in iter_bits(fence):
+                for d, delta in self.deltas:
+                    p, b2 = b - delta, b + delta
+                    if (fixed | corral) >> p & 1:
+                        continue  # no room to push from
+                    if corral >> b2 & 1:
+                        if not reach >> p & 1:
+                            break
+                        pushes.append((b, d, delta))
+                    elif not (fixed | self.dead) >> b2 & 1:
+                        break  # may be pushed out, or along the fence
+                else:
+                    continue
+                break
+            else:
+                if best is None or len(pushes) < len(best):
+                    best = pushes
+        return best
+
+    def walk_distances(self, player, reach):
+        """ dict of cell index -> steps to walk there from cell player,
+        for each cell of reach. The rings of cells one step further are
+        grown as bitmasks, like board.reachable.
+        """
+        w = self.w
+        dist = {player: 0}
+        seen = ring = 1 << player
+        k = 0
+        while ring:
+            k += 1
+            ring = (ring << 1 | ring >> 1 | ring << w | ring >> w) & reach
+            ring &= ~seen
+            seen |= ring
+            for c in iter_bits(ring):
+                dist[c] = k
+        return dist
+
+    def children(self, boxes, box_hash, player, reach, h, est, known=None):
+        """ expansion core of every driver: yield (box index, direction,
+        cost, new boxes, new box hash, new reach, key, new h, new estimate)
+        for each push from the state, skipping known deadlocks.
+        cost is 1 push, or the moves to walk to the box and push it.
+        known is an optional function (key, cost) returning true to skip
+        a child before its estimate is computed.
+        """
+        dist = None
+        if self.objective == MOVES:
+            dist = self.walk_distances(player, reach)
+        for b, d, new_boxes, new_hash in self.pushes(boxes, box_hash, reach):
+            delta = self.level.deltas[d]
+            cost = 1 if dist is None else dist[b - delta] + 1
+            new_reach, norm = self.normalize(b, new_boxes)
+            key = self.key(new_hash, b, norm)
+            if known is not None and known(key, cost):
+                continue
+            new_h, new_est = self.update_estimate(h, est, b, b + delta)
+            if new_h >= UNREACHABLE:
+                continue
+            yield (b, d, cost, new_boxes, new_hash, new_reach, key, new_h,
+                   new_est)
+
+    def check_limits(self, stored):
+        """ return the reason to stop searching, or None to go on """
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            return NODE_LIMIT
+        if self.max_stored is not None and stored >= self.max_stored:
+            return MEMORY_LIMIT
+        if self.nodes % 256 == 0:
+            if (self.max_seconds is not None
+                    and time.time() - self.t0 >= self.max_seconds):
+                return TIME_LIMIT
+            if self.cancel is not None and self.cancel.is_set():
+                return CANCELLED
+        return None
+
+    def result(self, status, pushes=None):
+        if pushes is not None:
+            pushes = [(to_pos(b, self.w), d) for b, d in pushes]
+        return SearchResult(status, pushes, self.nodes, time.time() - self.t0)
+
+    def _root(self):
+        """ (boxes, box hash, player, reach, key) of the current state """
+        level = self.level
+        boxes, player = level.box_bits, level.player_idx
+        box_hash = self.keys.box_hash(boxes)
+        reach, norm = self.normalize(player, boxes)
+        return boxes, box_hash, player, reach, self.key(box_hash, player,
+                                                          norm)
+
+    def astar(self):
+        """ best-first search. A* ordered by cost so far plus estimate for
+        PUSHES and MOVES: optimal, since the heuristic is admissible.
+        Greedy, ordered by the estimate alone, for ANY: states are never
+        reopened, and the first solution found is returned.
+        Parent links live in the heap entries, so the transposition table
+        can evict states without losing the path to the ones still queued.
+        """
+        boxes, box_hash, player, reach, key = self._root()
+        h, est = self.estimate(boxes)
+        if h >= UNREACHABLE:
+            return self.result(UNSOLVABLE)
+        greedy = self.objective == ANY
+        table = TranspositionTable(self.table_size, LRU)  # key -> lowest g
+        table.put(key, 0)
+        g = 0
+
+        def known(child, cost):
+            best = table.get(child)
+            return best is not None and (greedy or g + cost >= best[0])
+
+        tie = 0  # insertion order, so the heap never compares further
+        # f, -g, tie, boxes, box hash, player, reach, key, h,
+        # estimate data, path node (b, d, parent node)
+        heap = [(h, 0, tie, boxes, box_hash, player, reach, key, h, est,
+                 None)]
+        while heap:
+            (_, neg_g, _, boxes, box_hash, player, reach, key, h, est,
+             node) = heappop(heap)
+            g = -neg_g
+            best = table.get(key)
+            if best is not None and g > best[0]:
+                continue  # stale entry, a shorter path was found since
+            if self.goals & ~boxes == 0:
+                return self.result(SOLVED, self._path(node))
+            rest = self.finishes.get(key)
+            if rest is not None:  # solved before from there
+                return self.result(SOLVED, self._path(node) + rest)
+            stop = self.check_limits(len(table) + len(heap))
+            if stop:
+                return self.result(stop)
+            self.nodes += 1
+            for (b, d, cost, new_boxes, new_hash, new_reach, child, new_h,
+                 new_est) in self.children(boxes, box_hash, player, reach,
+                                           h, est, known):
+                table.put(child, g + cost)
+                tie += 1
+                f = new_h if greedy else g + cost + new_h
+                heappush(heap, (f, -g - cost, tie, new_boxes, new_hash, b,
+                                new_reach, child, new_h, new_est,
+                                (b, d, node)))
+        return self.result(UNSOLVABLE)
+
+    def _path(self, node):
+        path = []
+        while node is not None:
+            b, d, node = node
+            path.append((b, d))
+        return path[::-1]
+
+    def idastar(self):
+        """ IDA*, for PUSHES or MOVES. Uses memory proportional to the
+        depth only, apart from a per-iteration transposition table that
+        cuts transpositions, and prefers to keep states close to the root.
+        """
+        if self.objective == ANY:
+            raise ValueError('IDA* only searches optimal solutions')
+        boxes, box_hash, player, reach, key = self._root()
+        h, est = self.estimate(boxes)
+        if h >= UNREACHABLE:
+            return self.result(UNSOLVABLE)
+        bound = h
+        path = []
+        while True:
+            table = TranspositionTable(self.table_size, DEPTH)
+            status, t = self._dfs(boxes, box_hash, player, reach, key, 0, h,
+                                  est, bound, path, table)
+            if status == SOLVED:
+                return self.result(SOLVED, path)
+            if status is not None:
+                return self.result(status)
+            if t is None:
+                return self.result(UNSOLVABLE)
+            bound = t
+
+    def _dfs(self, boxes, box_hash, player, reach, key, g, h, est, bound,
+             path, table):
+        """ return (status, next bound). status is None to keep iterating. """
+        if g + h > bound:
+            return None, g + h
+        if self.goals & ~boxes == 0:
+            return SOLVED, None
+        seen = table.get(key)
+        if seen is not None and seen[0] <= g:
+            return None, None  # already searched from here, at lower cost
+        table.put(key, g)
+        stop = self.check_limits(len(table))
+        if stop:
+            return stop, None
+        self.nodes += 1
+        next_bound = None
+        for (b, d, cost, new_boxes, new_hash, new_reach, child, new_h,
+             new_est) in self.children(boxes, box_hash, player, reach, h,
+                                       est):
+            path.append((b, d))
+            status, t = self._dfs(new_boxes, new_hash, b, new_reach, child,
+                                  g + cost, new_h, new_est, bound, path,
+                                  table)
+            if status is not None:
+                return status, None
+            path.pop()
+            if t is not None and (next_bound is None or t < next_bound):
+                next_bound = t
+        return None, next_bound
+
+
+def solve(level, method='astar', max_nodes=None, max_seconds=None,
+          max_memory=None, heuristic=MATCHING, cancel=None,
+          objective=PUSHES, finishes=None):
+    """ search pushes that solve level from its current state.
+    method is 'astar' or 'idastar'.
+    objective is PUSHES or MOVES for a solution with the fewest pushes
+    or moves, or ANY for the first solution a greedy search finds, which
+    is much faster. IDA* does not do ANY.
+    heuristic, cancel and finishes are passed to Search.
+    return a SearchResult.
+    """
+    log = logging.getLogger('game')
+    search = Search(level, max_nodes, max_seconds, max_memory, heuristic,
+                    cancel, objective, finishes)
+    if method == 'astar':
+        res = search.astar()
+    elif method == 'idastar':
+        res = search.idastar()
+    else:
+        raise ValueError('unknown search method %s' % method)
+    log.debug('level %d, %s: %s' % (level.level_num, objective, res))
+    return res
+
+
+def state_key(level, boxes, player):
+    """ key of the state of level with boxes and the player on cell player,
+    as Search.key gives it when counting pushes
+    """
+    keys = level.zobrist
+    _, norm = player_area(player, ~(level.wall_bits | boxes), level.width)
+    return keys.box_hash(boxes) ^ keys.player[norm]
+
+
+def walk_path(level, player, boxes, target):
+    """ shortest list of directions to walk from cell player to cell target
+    without pushing any box. return None if target is not reachable.
+    """
+    blocked = level.wall_bits | boxes
+    parents = {player: None}
+    frontier = [player]
+    while frontier and target not in parents:
+        nxt = []
+        for i in frontier:
+            for d in DIRECTIONS:
+                j = i + level.deltas[d]
+                if j not in parents and not blocked >> j & 1:
+                    parents[j] = (i, d)
+                    nxt.append(j)
+        frontier = nxt
+    if target not in parents:
+        return None
+    path = []
+    while parents[target] is not None:
+        target, d = parents[target]
+        path.append(d)
+    return path[::-1]
+
+
+def _expand(level, pushes):
+    """ yield (direction, pushed) for each step of the player replaying
+    pushes from the current state of level.
+    """
+    w = level.width
+    player, boxes = level.player_idx, level.box_bits
+    for (y, x), d in pushes:
+        b = y * w + x
+        delta = level.deltas[d]
+        for step in walk_path(level, player, boxes, b - delta):
+            yield step, False
+        yield d, True
+        boxes ^= 1 << b | 1 << (b + delta)
+        player = b
+
+
+def pushes_to_moves(level, pushes):
+    """ expand pushes, as returned in SearchResult.pushes, into the list of
+    directions the player takes from the current state of level.
+    """
+    return [d for d, _ in _expand(level, pushes)]
+
+
+def pushes_to_lurd(level, pushes):
+    """ like pushes_to_moves, but return a string in LURD notation:
+    lowercase letters for steps, uppercase letters for pushes.
+    """
+    return ''.join(LURD[d].upper() if pushed else LURD[d]
+                   for d, pushed in _expand(level, pushes))
+
+
+################# TESTS ##################
+
+
+def _test_level():
+    from level import build_level_from_tiles
+    level_str = (
+        "####\n"
+        "# .#\n"
+        "#  ###\n"
+        "#*@  #\n"
+        "#  $ #\n"
+        "#  ###\n"
+        "####"
+    )
+    tiles = list(map(lambda x: list(x), level_str.split(sep='\n')))
+    return build_level_from_tiles(tiles, 16)
+
+
+def test_solve_astar():
+    level = _test_level()
+    res = solve(level)
+    assert res.solved
+    assert len(res.pushes) == 8  # known optimum of microban level 1
+    for d in pushes_to_moves(level, res.pushes):
+        assert level.move(d)
+    assert level.is_complete()
+    level.reset()
+    lurd = pushes_to_lurd(level, res.pushes)
+    assert sum(c.isupper() for c in lurd) == 8
+    assert lurd.lower() == ''.join(LURD[d] for d in
+                                   pushes_to_moves(level, res.pushes))
+
+
+def test_solve_idastar():
+    level = _test_level()
+    res = solve(level, method='idastar')
+    assert res.solved
+    assert len(res.pushes) == 8
+
+
+def _fewest_moves(level):
+    """ moves of the shortest solution, by breadth-first search over
+    every (player, boxes) state, without any deadlock pruning
+    """
+    start = level.snapshot()
+    frontier, seen, n = [start], {start[:2]}, 0
+    while frontier:
+        nxt = []
+        for snap in frontier:
+            level.restore(snap)
+            if level.is_complete():
+                level.restore(start)
+                return n
+            for d in DIRECTIONS:
+                level.restore(snap)
+                if level.move(d):
+                    s = level.snapshot()
+                    if s[:2] not in seen:
+                        seen.add(s[:2])
+                        nxt.append(s)
+        frontier, n = nxt, n + 1
+    level.restore(start)
+    return None
+
+
+def test_objectives():
+    level = _test_level()
+    best = _fewest_moves(level)
+    for method in ('astar', 'idastar'):
+        res = solve(level, method, objective=MOVES)
+        assert res.solved
+        assert len(pushes_to_moves(level, res.pushes)) == best
+    res = solve(level, objective=PUSHES)
+    assert len(pushes_to_moves(level, res.pushes)) >= best
+    res = solve(level, objective=ANY)
+    assert res.solved and len(res.pushes) >= 8
+    for d in pushes_to_moves(level, res.pushes):
+        assert level.move(d)
+    assert level.is_complete()
+    level.reset()
+    try:
+        solve(level, 'idastar', objective=ANY)
+        assert False, 'IDA* has no greedy mode'
+    except ValueError:
+        pass
+
+
+def test_surplus_boxes():
+    """ boxes left over may sit on dead squares, or stay frozen """
+    from level import build_level_from_tiles
+    levels = [
+        ['######', '#@ $.#', '#  $ #', '######'],
+        ['########', '### @  #', '#.#  # #', '##$. $ #', '########'],
+        ['#######', '#     #', '#$ ## #', '#  @$ #', '#  .  #', '#######'],
+        ['#######', '#     #', '#    ##', '#  @$ #', '#$$.  #', '#######'],
+    ]
+    for rows in levels:
+        level = build_level_from_tiles([list(r) for r in rows])
+        assert level.surplus > 0 and not level.deadlocked
+        best = _fewest_moves(level)
+        res = solve(level, objective=MOVES)
+        assert len(pushes_to_moves(level, res.pushes)) == best
+        for objective in (PUSHES, ANY):
+            assert solve(level, objective=objective).solved
+
+
+def test_finishes():
+    level = _test_level()
+    res = solve(level, objective=ANY)
+    w = level.width
+    path = [(y * w + x, d) for (y, x), d in res.pushes]
+    boxes, player = level.box_bits, level.player_idx
+    # from the root: nothing to search
+    finishes = {state_key(level, boxes, player): path}
+    again = solve(level, objective=ANY, finishes=finishes)
+    assert again.pushes == res.pushes and again.nodes == 0
+    # after the first push: the search joins it
+    b, d = path[0]
+    boxes ^= 1 << b | 1 << (b + level.deltas[d])
+    finishes = {state_key(level, boxes, b): path[1:]}
+    again = solve(level, objective=ANY, finishes=finishes)
+    assert again.solved and again.nodes < res.nodes
+    for d in pushes_to_moves(level, again.pushes):
+        assert level.move(d)
+    assert level.is_complete()
+    level.reset()
+    try:
+        solve(level, finishes=finishes)
+        assert False, 'finishes are not optimal'
+    except ValueError:
+        pass
+
+
+def test_limits():
+    level = _test_level()
+    res = solve(level, max_nodes=2)
+    assert res.status == NODE_LIMIT and res.pushes is None
+    res = solve(level, max_memory=NODE_BYTES * 10 / 1024 / 1024)
+    assert res.status == MEMORY_LIMIT
+
+
+if __name__ == "__main__":
+    test_solve_astar()
+    test_solve_idastar()
+    test_objectives()
+    test_surplus_boxes()
+    test_finishes()
+    test_limits()
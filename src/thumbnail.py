@@ -0,0 +1,243 @@
+""" Level thumbnails, for the menu.
+A thumbnail is made straight from the wall, goal and box bitmasks of a
+level: one pixel per cell, then scaled up, without any sprite blit.
+ThumbnailCache makes the thumbnails of a level set in a worker thread, and
+keeps them in an atlas next to the level-set file: a PNG of square slots,
+and a JSON index of level digest -> slot. There is an atlas per thumbnail
+size, ie per resolution. Later runs only make the thumbnails of new or
+changed levels.
+Levels are read as bitmasks, see Level.bits: from a compiled level set,
+thumbnails are made without building any Level.
+"""
+import json
+import logging
+import os
+import threading
+import pygame as pg
+from board import iter_bits, reachable
+from constants import TRANSPARENT
+from level import digest_bits
+
+
+ATLAS_COLS = 16  # slots per row of the atlas
+WALL = (160, 104, 70)
+FLOOR = (222, 196, 160)
+GOAL = (0, 162, 232)
+BOX = (185, 122, 87)
+BOX_ON_GOAL = (0, 96, 140)
+PLAYER = (255, 255, 255)
+
+
+def thumbnail_pixels(bits):
+    """ RGB bytes of a starting position, one pixel per cell.
+    bits is (w, h, walls, goals, player, boxes), see Level.bits.
+    Cells outside of the walls are TRANSPARENT.
+    """
+    w, h, walls, goals, player, boxes = bits
+    floor = reachable(player, ~walls, w)  # the walls enclose the player
+    buf = bytearray(bytes(TRANSPARENT) * (w * h))
+    for cells, color in ((floor, FLOOR), (walls, WALL),
+                         (goals & ~boxes, GOAL), (boxes & ~goals, BOX),
+                         (boxes & goals, BOX_ON_GOAL), (1 << player, PLAYER)):
+        color = bytes(color)
+        for i in iter_bits(cells):
+            buf[3 * i:3 * i + 3] = color
+    return bytes(buf)
+
+
+def render_thumbnail(bits, size):
+    """ surface of a starting position given as bitmasks, see
+    thumbnail_pixels, at most size pixels wide and high.
+    Each cell is a block of the same number of pixels. A level of more
+    than size cells across is smoothed down to fit instead.
+    """
+    w, h = bits[:2]
+    img = pg.image.frombuffer(thumbnail_pixels(bits), (w, h), 'RGB')
+    if max(w, h) > size:
+        scale = size / max(w, h)
+        img = pg.transform.smoothscale(
+            img, (max(1, round(w * scale)), max(1, round(h * scale))))
+    else:
+        block = size // max(w, h)
+        img = pg.transform.scale(img, (w * block, h * block))
+    img.set_colorkey(TRANSPARENT)
+    return img
+
+
+def atlas_paths(filepath, size):
+    """ image and index files of the atlas of thumbnails of a given size """
+    base = '%s.thumbs%d' % (filepath, size)
+    return base + '.png', base + '.json'
+
+
+def _slot_pos(slot, size):
+    """ topleft pixel of a slot of the atlas of thumbnails of size """
+    return slot % ATLAS_COLS * size, slot // ATLAS_COLS * size
+
+
+class ThumbnailCache:
+    """ Thumbnails of the levels of a level set, at one size.
+    start() loads the atlas, then makes the missing thumbnails, in a worker
+    thread. get(i) returns the thumbnail of level i, or None if not ready.
+    made counts the thumbnails ready so far: when it changes, there are new
+    ones to draw.
+    """
+
+    def __init__(self, levels, filepath, size):
+        self.levels = levels
+        self.filepath = filepath
+        self.size = size
+        self.made = 0
+        self._thumbs = {}  # level index -> surface
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, i):
+        return self._thumbs.get(i)
+
+    def _bits(self, i):
+        """ bitmasks of level i, from the cache file when levels is a
+        level_cache.CompiledLevelSet, so that no Level is built
+        """
+        if hasattr(self.levels, 'record_bits'):
+            return self.levels.record_bits(i)[1]
+        return self.levels[i].bits()
+
+    def start(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='thumbnails')
+        self._thread.start()
+
+    def stop(self):
+        """ end the worker thread. thumbnails made so far are saved. """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def set_size(self, size):
+        """ resolution changed: make thumbnails of the new size instead """
+        if size == self.size:
+            return
+        running = self._thread is not None
+        self.stop()
+        self.size = size
+        self.made = 0
+        self._thumbs = {}
+        if running:
+            self.start()
+
+    def _run(self):
+        log = logging.getLogger('game')
+        atlas = self._load()
+        new = 0
+        for i in range(len(self.levels)):
+            if self._stop.is_set():
+                break
+            bits = self._bits(i)
+            digest = digest_bits(*bits)
+            img = atlas.get(digest)
+            if img is None:
+                img = atlas[digest] = render_thumbnail(bits, self.size)
+                new += 1
+            self._thumbs[i] = img
+            self.made += 1
+        if new:
+            self._save(atlas)
+        log.debug('%d level thumbnails of %dpx ready, %d new'
+                  % (self.made, self.size, new))
+
+    def _load(self):
+        """ dict of digest -> thumbnail, from the atlas file if any """
+        png, index = atlas_paths(self.filepath, self.size)
+        if not (os.path.isfile(png) and os.path.isfile(index)):
+            return {}
+        try:
+            with open(index, 'r') as f:
+                slots = json.load(f)
+            img = pg.image.load(png)
+        except (OSError, ValueError, pg.error):
+            return {}  # made again, and saved over
+        thumbs = {}
+        for digest, (slot, w, h) in slots.items():
+            thumb = img.subsurface(_slot_pos(slot, self.size) + (w, h))
+            thumb.set_colorkey(TRANSPARENT)
+            thumbs[digest] = thumb
+        return thumbs
+
+    def _save(self, thumbs):
+        """ write the atlas of thumbs, a dict of digest -> thumbnail """
+        log = logging.getLogger('game')
+        png, index = atlas_paths(self.filepath, self.size)
+        rows = (len(thumbs) + ATLAS_COLS - 1) // ATLAS_COLS
+        img = pg.Surface((ATLAS_COLS * self.size, rows * self.size))
+        img.fill(TRANSPARENT)
+        slots = {}
+        for slot, (digest, thumb) in enumerate(sorted(thumbs.items())):
+            img.blit(thumb, _slot_pos(slot, self.size))
+            slots[digest] = (slot,) + thumb.get_size()
+        try:
+            pg.image.save(img, png)
+            with open(index, 'w') as f:
+                json.dump(slots, f)
+        except (OSError, pg.error) as e:
+            log.warning('could not write thumbnail atlas %s: %s' % (png, e))
+
+
+################# TESTS ##################
+
+
+def test_render_thumbnail():
+    from constants import DIRE
+    from level import build_level_from_tiles
+    rows = ['#####', '#@$.#', '#####']
+    level = build_level_from_tiles([list(r) for r in rows])
+    img = render_thumbnail(level.bits(), 16)
+    assert img.get_size() == (15, 9)  # blocks of 3 pixels per cell
+    assert img.get_at((0, 0))[:3] == WALL
+    assert img.get_at((4, 4))[:3] == PLAYER
+    assert img.get_at((7, 4))[:3] == BOX
+    assert img.get_at((10, 4))[:3] == GOAL
+    level.move(DIRE)  # thumbnails show the starting position
+    assert render_thumbnail(level.bits(), 16).get_at((7, 4))[:3] == BOX
+    assert render_thumbnail(level.bits(), 3).get_size() == (3, 2)
+
+
+def test_thumbnail_cache():
+    import time
+    from level import load_level_set
+    from level_cache import cache_path, load_compiled_level_set
+    filename = 'levelset.txt.test'
+    with open(filename, 'w') as f:
+        f.write('\n'.join(['#####', '#@$.#', '#####']) + '\n\n')
+        f.write('\n'.join(['#####', '#+ $#', '#$.*#', '#####']) + '\n\n')
+        f.write('\n'.join(['#####', '#@$.#', '#####']) + '\n')
+    levels = load_level_set(filename)
+    compiled = load_compiled_level_set(filename)
+    for run in (levels, compiled):  # make the atlas, then read it
+        thumbs = ThumbnailCache(run, filename, 20)
+        thumbs.start()
+        t0 = time.time()
+        while thumbs.made < len(levels) and time.time() - t0 < 5:
+            time.sleep(0.01)
+        thumbs.stop()
+        assert thumbs.made == 3
+        assert thumbs.get(1).get_size() == (20, 16)
+        assert thumbs.get(0).get_at((5, 5))[:3] == PLAYER
+    assert not compiled._levels  # thumbnails come from the cache records
+    compiled.close()
+    with open(atlas_paths(filename, 20)[1]) as f:
+        assert len(json.load(f)) == 2  # levels 0 and 2 are the same
+    thumbs.set_size(10)
+    assert thumbs.made == 0 and thumbs.get(0) is None
+    for path in (filename, cache_path(filename)) + atlas_paths(filename, 20):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    test_render_thumbnail()
+    test_thumbnail_cache()
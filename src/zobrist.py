@@ -0,0 +1,151 @@
+""" Zobrist hashing of game states, and a bounded transposition table.
+A state hash is the XOR of one random 64-bit key per box cell,
+and one key for the player cell. Moving a box or the player only
+XORs out the old key and XORs in the new one.
+"""
+from collections import OrderedDict
+import random
+from board import iter_bits
+
+
+SEED = 0x50c0ba17  # fixed, so hashes are stable between runs
+
+_keys_cache = {}  # number of cells -> ZobristKeys
+
+
+class ZobristKeys:
+    """ random keys for boxes and player, one per cell index """
+
+    def __init__(self, n_cells, seed=SEED):
+        rng = random.Random(seed)
+        self.box = [rng.getrandbits(64) for _ in range(n_cells)]
+        self.player = [rng.getrandbits(64) for _ in range(n_cells)]
+
+    def box_hash(self, box_bits):
+        """ hash of a box bitmask, computed from scratch """
+        h = 0
+        for i in iter_bits(box_bits):
+            h ^= self.box[i]
+        return h
+
+
+def keys_for(n_cells):
+    """ shared keys for all boards with n_cells cells """
+    keys = _keys_cache.get(n_cells)
+    if keys is None:
+        keys = _keys_cache[n_cells] = ZobristKeys(n_cells)
+    return keys
+
+
+# replacement policies of a full TranspositionTable
+LRU, DEPTH = 'lru', 'depth'
+
+
+class TranspositionTable:
+    """ map of state hashes to search data, holding at most max_entries.
+    With LRU, a full table evicts the least recently used entry.
+    With DEPTH, the table is a fixed array of slots indexed by hash;
+    a new entry replaces the slot's entry unless the latter was stored
+    at a lower depth, since states close to the root prune more.
+    max_entries None means unbounded, and policy is then irrelevant.
+    """
+
+    def __init__(self, max_entries=None, policy=LRU):
+        if policy not in (LRU, DEPTH):
+            raise ValueError('unknown replacement policy %s' % policy)
+        self.max_entries = max_entries
+        self.policy = policy if max_entries is not None else None
+        self.hits = self.misses = self.evictions = 0
+        if self.policy == DEPTH:
+            self._slots = [None] * max_entries  # (key, depth, value)
+            self._count = 0
+        else:
+            self._d = OrderedDict() if self.policy == LRU else {}
+
+    def __len__(self):
+        if self.policy == DEPTH:
+            return self._count
+        return len(self._d)
+
+    def get(self, key, default=None):
+        """ return (depth, value) stored for key, or default """
+        if self.policy == DEPTH:
+            e = self._slots[key % self.max_entries]
+            if e is not None and e[0] == key:
+                self.hits += 1
+                return e[1], e[2]
+        else:
+            e = self._d.get(key)
+            if e is not None:
+                self.hits += 1
+                if self.policy == LRU:
+                    self._d.move_to_end(key)
+                return e
+        self.misses += 1
+        return default
+
+    def put(self, key, depth, value=None):
+        """ store value found at depth for key. return False if the
+        replacement policy kept another entry instead.
+        """
+        if self.policy == DEPTH:
+            i = key % self.max_entries
+            e = self._slots[i]
+            if e is None:
+                self._count += 1
+            elif e[0] != key:
+                if e[1] < depth:
+                    return False
+                self.evictions += 1
+            self._slots[i] = (key, depth, value)
+            return True
+        d = self._d
+        if self.policy == LRU:
+            if key in d:
+                d.move_to_end(key)
+            elif len(d) >= self.max_entries:
+                d.popitem(last=False)
+                self.evictions += 1
+        d[key] = (depth, value)
+        return True
+
+
+################# TESTS ##################
+
+
+def test_box_hash():
+    keys = keys_for(256)
+    assert keys is keys_for(256)  # shared between boards of the same size
+    assert keys.box_hash(0) == 0
+    bits = 1 << 3 | 1 << 200
+    assert keys.box_hash(bits) == keys.box[3] ^ keys.box[200]
+    # incremental update: push the box from 3 to 4
+    h = keys.box_hash(bits) ^ keys.box[3] ^ keys.box[4]
+    assert h == keys.box_hash(1 << 4 | 1 << 200)
+
+
+def test_transposition_lru():
+    tt = TranspositionTable(2, LRU)
+    tt.put(1, 0, 'a')
+    tt.put(2, 0, 'b')
+    assert tt.get(1) == (0, 'a')  # 1 is now more recent than 2
+    tt.put(3, 0, 'c')
+    assert tt.get(2) is None
+    assert tt.get(1) == (0, 'a') and tt.get(3) == (0, 'c')
+    assert len(tt) == 2 and tt.evictions == 1
+
+
+def test_transposition_depth():
+    tt = TranspositionTable(4, DEPTH)
+    assert tt.put(1, 3, 'a')
+    assert not tt.put(5, 4, 'b')  # same slot, deeper: keep the shallow one
+    assert tt.get(1) == (3, 'a')
+    assert tt.put(5, 2, 'c')  # shallower replaces
+    assert tt.get(1) is None and tt.get(5) == (2, 'c')
+    assert len(tt) == 1
+
+
+if __name__ == "__main__":
+    test_box_hash()
+    test_transposition_lru()
+    test_transposition_depth()